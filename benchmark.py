@@ -0,0 +1,549 @@
+import argparse
+import base64
+import contextlib
+import hashlib
+import importlib.util
+import json
+import math
+import os
+import random
+import resource
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Text, Tuple
+
+from inventory_io import open_inventory
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SIZE_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+
+def load_script(filename: Text) -> Any:
+    """Import one of the top-level scripts as a module (they are not a package)."""
+    module_name = os.path.splitext(filename)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(
+        module_name, os.path.join(HERE, filename)
+    )
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)  # type: ignore
+    return module
+
+
+class SyntheticSpec:
+    def __init__(
+        self,
+        files: int,
+        dupe_ratio: float,
+        depth: int,
+        width: int,
+        size_dist: Text,
+        mean_size: int,
+        max_size: int,
+        non_utf8_ratio: float,
+        seed: int,
+    ) -> None:
+        assert size_dist in SIZE_DISTRIBUTIONS, "Unknown size distribution"
+        assert 0 <= dupe_ratio <= 1, "Dupe ratio must be between 0 and 1"
+        self.files = files
+        self.dupe_ratio = dupe_ratio
+        self.depth = depth
+        self.width = width
+        self.size_dist = size_dist
+        self.mean_size = mean_size
+        self.max_size = max_size
+        self.non_utf8_ratio = non_utf8_ratio
+        self.seed = seed
+
+    def draw_size(self, rng: random.Random) -> int:
+        if self.size_dist == "fixed":
+            size = self.mean_size
+        elif self.size_dist == "uniform":
+            size = rng.randint(0, 2 * self.mean_size)
+        else:
+            # sigma=1.5 gives the long tail typical of home/backup shares
+            sigma = 1.5
+            mu = math.log(max(self.mean_size, 1)) - sigma * sigma / 2
+            size = int(rng.lognormvariate(mu, sigma))
+        return min(size, self.max_size)
+
+    def entries(self) -> Iterator[Tuple[bytes, int, int]]:
+        """Yield (relative path, size, content id) for every synthetic file.
+
+        Files sharing a content id have identical contents. The sequence only
+        depends on the spec, so trees and inventories are reproducible.
+        """
+        rng = random.Random(self.seed)
+        directories = _directory_layout(self.depth, self.width)
+        originals = []  # type: List[Tuple[int, int]]
+        for index in range(self.files):
+            if originals and rng.random() < self.dupe_ratio:
+                size, content_id = rng.choice(originals)
+            else:
+                size, content_id = self.draw_size(rng), index
+                originals.append((size, content_id))
+
+            name = "f{}.bin".format(index).encode("utf-8")
+            if rng.random() < self.non_utf8_ratio:
+                name = b"f" + str(index).encode("utf-8") + b"-\xe9\xff.bin"
+            directory = rng.choice(directories)
+            yield os.path.join(directory, name), size, content_id
+
+
+def _directory_layout(depth: int, width: int) -> List[bytes]:
+    directories = [b""]
+    level = [b""]
+    for _ in range(depth):
+        level = [
+            os.path.join(parent, "d{}".format(i).encode("utf-8"))
+            for parent in level
+            for i in range(width)
+        ]
+        directories.extend(level)
+    return directories
+
+
+def content_for(content_id: int, size: int) -> bytes:
+    block = hashlib.sha256(str(content_id).encode("utf-8")).digest() * 128
+    repeats, remainder = divmod(size, len(block))
+    return block * repeats + block[:remainder]
+
+
+def generate_tree(spec: SyntheticSpec, root: Text) -> int:
+    """Write the synthetic files under root and return the total bytes written."""
+    root_bytes = os.fsencode(root)
+    total = 0
+    for rel_path, size, content_id in spec.entries():
+        full_path = os.path.join(root_bytes, rel_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(content_for(content_id, size))
+        total += size
+    return total
+
+
+def _digest_for(content_id: int) -> Text:
+    return hashlib.md5(str(content_id).encode("utf-8")).hexdigest()
+
+
+def generate_inventory(
+    spec: SyntheticSpec,
+    prefix: Text,
+    hashes_file: Text,
+    sizes_file: Text,
+    drop_ratio: float = 0.0,
+) -> int:
+    """Write a DiskReader-style hashes/sizes pair without touching the disk.
+
+    A fraction drop_ratio of the records is left out, which is how the
+    "test" side of find_missing_files.py / ensure_exact_files.py is built.
+    Returns the number of records written.
+    """
+    rng = random.Random(spec.seed + 1)
+    prefix_bytes = os.fsencode(prefix)
+    written = 0
+    with open(hashes_file, "w", encoding="utf-8") as hashes_out, open(
+        sizes_file, "w", encoding="utf-8"
+    ) as sizes_out:
+        for rel_path, size, content_id in spec.entries():
+            if drop_ratio and rng.random() < drop_ratio:
+                continue
+
+            path_bytes = os.path.join(prefix_bytes, rel_path)
+            try:
+                path_bytes.decode("utf-8", errors="strict")
+                is_utf8 = "utf-8"
+            except UnicodeDecodeError:
+                is_utf8 = "unknown-encoding"
+            b64path = base64.b64encode(path_bytes).decode("utf-8")
+            hashes_out.write(
+                "{}  {}  {}\n".format(_digest_for(content_id), is_utf8, b64path)
+            )
+            sizes_out.write("{}  {}  {}\n".format(size, is_utf8, b64path))
+            written += 1
+    return written
+
+
+def generate_legacy_records(
+    spec: SyntheticSpec, prefix: Text, hashes_file: Text, sizes_file: Text
+) -> None:
+    """Write the "<value> <path>" records read by dupe-finder.py."""
+    with open(hashes_file, "w", encoding="utf-8") as hashes_out, open(
+        sizes_file, "w", encoding="utf-8"
+    ) as sizes_out:
+        for rel_path, size, content_id in spec.entries():
+            path_text = os.path.join(prefix, rel_path.decode("utf-8", "replace"))
+            hashes_out.write("{} {}\n".format(_digest_for(content_id), path_text))
+            sizes_out.write("{} {}\n".format(size, path_text))
+
+
+# Benchmark cases. Each runs inside a fresh child process so that peak RSS and
+# bytes read belong to that case alone.
+
+
+def case_disk_reader(workdir: Text) -> None:
+    module = load_script("find_hashes_and_sizes.py")
+    reader = module.DiskReader(
+        os.path.join(workdir, "tree"),
+        os.path.join(workdir, "scan_hashes.txt"),
+        os.path.join(workdir, "scan_sizes.txt"),
+        True,
+        False,
+    )
+    reader.run()
+
+
+def case_file_dupes_tree(workdir: Text) -> None:
+    module = load_script("dupe-finder.py")
+    module.file_dupes(os.path.join(workdir, "tree"), None, None)
+
+
+def case_file_dupes_records(workdir: Text) -> None:
+    module = load_script("dupe-finder.py")
+    module.file_dupes(
+        "/bench",
+        os.path.join(workdir, "legacy_hashes.txt"),
+        os.path.join(workdir, "legacy_sizes.txt"),
+    )
+
+
+def case_file_dupes_records_numpy(workdir: Text) -> None:
+    module = load_script("dupe-finder.py")
+    module.file_dupes(
+        "/bench",
+        os.path.join(workdir, "legacy_hashes.txt"),
+        os.path.join(workdir, "legacy_sizes.txt"),
+        engine="numpy",
+    )
+
+
+def case_file_dupes_out_of_core(workdir: Text) -> None:
+    module = load_script("out_of_core.py")
+    module.file_dupes_out_of_core(
+        "/bench",
+        os.path.join(workdir, "legacy_hashes.txt"),
+        os.path.join(workdir, "legacy_sizes.txt"),
+        module.max_lines_for(64 << 20),
+        workdir,
+    )
+
+
+def case_find_missing_files(workdir: Text) -> None:
+    _run_script(
+        "find_missing_files.py",
+        [
+            os.path.join(workdir, "ref_hashes.txt"),
+            os.path.join(workdir, "test_hashes.txt"),
+            "-o",
+            os.path.join(workdir, "missing.txt"),
+        ],
+    )
+
+
+def case_ensure_exact_files(workdir: Text) -> None:
+    _run_script(
+        "ensure_exact_files.py",
+        [
+            os.path.join(workdir, "ref_hashes.txt"),
+            os.path.join(workdir, "test_hashes.txt"),
+        ],
+    )
+
+
+def _read_inventory(workdir: Text, filename: Text, processes: int) -> None:
+    with open_inventory(
+        os.path.join(workdir, filename), "r", processes=processes
+    ) as inventory_handle:
+        for _ in inventory_handle:
+            pass
+
+
+def case_inventory_read_plain(workdir: Text) -> None:
+    _read_inventory(workdir, "ref_hashes.txt", 1)
+
+
+def case_inventory_read_gzip(workdir: Text) -> None:
+    _read_inventory(workdir, "ref_hashes.txt.gz", 1)
+
+
+def case_inventory_read_gzip_parallel(workdir: Text) -> None:
+    _read_inventory(workdir, "ref_hashes.txt.gz", 4)
+
+
+def case_inventory_read_xz(workdir: Text) -> None:
+    _read_inventory(workdir, "ref_hashes.txt.xz", 1)
+
+
+def case_inventory_read_xz_parallel(workdir: Text) -> None:
+    _read_inventory(workdir, "ref_hashes.txt.xz", 4)
+
+
+def _run_script(filename: Text, argv: List[Text]) -> None:
+    saved_argv = sys.argv
+    sys.argv = [filename] + argv
+    try:
+        runpy.run_path(os.path.join(HERE, filename), run_name="__main__")
+    finally:
+        sys.argv = saved_argv
+
+
+CASES = {
+    "disk_reader": case_disk_reader,
+    "file_dupes_tree": case_file_dupes_tree,
+    "file_dupes_records": case_file_dupes_records,
+    "file_dupes_records_numpy": case_file_dupes_records_numpy,
+    "file_dupes_out_of_core": case_file_dupes_out_of_core,
+    "find_missing_files": case_find_missing_files,
+    "ensure_exact_files": case_ensure_exact_files,
+    "inventory_read_plain": case_inventory_read_plain,
+    "inventory_read_gzip": case_inventory_read_gzip,
+    "inventory_read_gzip_parallel": case_inventory_read_gzip_parallel,
+    "inventory_read_xz": case_inventory_read_xz,
+    "inventory_read_xz_parallel": case_inventory_read_xz_parallel,
+}  # type: Dict[Text, Callable[[Text], None]]
+NUMPY_CASES = ("file_dupes_records_numpy",)
+
+
+def _read_proc_io() -> Dict[Text, int]:
+    counters = {}  # type: Dict[Text, int]
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key.strip()] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def _read_peak_rss() -> int:
+    """Peak RSS of this process in bytes.
+
+    ru_maxrss survives exec, so in a child of the (large) generator process it
+    would report the parent's high-water mark; VmHWM starts afresh.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    # Linux reports ru_maxrss in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_case_in_child(case: Text, workdir: Text, result_file: Text) -> None:
+    before = _read_proc_io()
+    # The scripts print progress and reports; keep that out of the measurements
+    with open(os.devnull, "w", errors="replace") as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            start = perf_counter()
+            CASES[case](workdir)
+            elapsed = perf_counter() - start
+    after = _read_proc_io()
+    # Children include worker processes, e.g. parallel decompression
+    cpu_seconds = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        cpu_seconds += usage.ru_utime + usage.ru_stime
+
+    result = {
+        "case": case,
+        "inner_seconds": elapsed,
+        "cpu_seconds": cpu_seconds,
+        "peak_rss_bytes": _read_peak_rss(),
+        "bytes_read": after.get("rchar", 0) - before.get("rchar", 0),
+        "disk_bytes_read": after.get("read_bytes", 0) - before.get("read_bytes", 0),
+    }
+    with open(result_file, "w") as f:
+        json.dump(result, f)
+
+
+def run_case(case: Text, workdir: Text, repeat: int) -> Dict[Text, Any]:
+    best = None  # type: Optional[Dict[Text, Any]]
+    for _ in range(repeat):
+        result_file = os.path.join(workdir, "result_{}.json".format(case))
+        start = perf_counter()
+        subprocess.check_call(
+            [sys.executable, os.path.abspath(__file__), "--child", case, workdir],
+            env=dict(os.environ, BENCH_RESULT_FILE=result_file),
+        )
+        wall = perf_counter() - start
+        with open(result_file) as f:
+            result = json.load(f)
+        result["wall_seconds"] = wall
+        if best is None or result["inner_seconds"] < best["inner_seconds"]:
+            best = result
+    assert best is not None
+    return best
+
+
+def prepare_workdir(
+    spec: SyntheticSpec, inventory_spec: SyntheticSpec, workdir: Text
+) -> None:
+    print("Generating synthetic tree ({} files)...".format(spec.files))
+    total = generate_tree(spec, os.path.join(workdir, "tree"))
+    print("Wrote {} bytes".format(total))
+
+    print(
+        "Generating synthetic inventories ({} records)...".format(inventory_spec.files)
+    )
+    generate_inventory(
+        inventory_spec,
+        "/bench/reference",
+        os.path.join(workdir, "ref_hashes.txt"),
+        os.path.join(workdir, "ref_sizes.txt"),
+    )
+    generate_inventory(
+        inventory_spec,
+        "/bench/test",
+        os.path.join(workdir, "test_hashes.txt"),
+        os.path.join(workdir, "test_sizes.txt"),
+        drop_ratio=0.05,
+    )
+    generate_legacy_records(
+        inventory_spec,
+        "/bench",
+        os.path.join(workdir, "legacy_hashes.txt"),
+        os.path.join(workdir, "legacy_sizes.txt"),
+    )
+
+
+def prepare_compressed_inventories(workdir: Text) -> None:
+    source = os.path.join(workdir, "ref_hashes.txt")
+    print("Compressing reference inventory...")
+    print("plain: {} bytes".format(os.path.getsize(source)))
+    for compression, suffix in (("gzip", ".gz"), ("xz", ".xz")):
+        with open(source, "r", encoding="utf-8") as source_handle:
+            with open_inventory(
+                source + suffix, "w", compression=compression
+            ) as output_handle:
+                shutil.copyfileobj(source_handle, output_handle)
+        print("{}: {} bytes".format(compression, os.path.getsize(source + suffix)))
+
+
+def print_results(
+    results: List[Dict[Text, Any]], baseline: Optional[Dict[Text, Dict[Text, Any]]]
+) -> None:
+    header = "{:<28} {:>10} {:>10} {:>12} {:>16} {:>12}".format(
+        "case", "wall (s)", "CPU (s)", "peak RSS MB", "read() MB [1]", "disk MB [2]"
+    )
+    if baseline:
+        header += " {:>10} {:>10}".format("time x", "RSS x")
+    print(header)
+    for result in results:
+        line = "{:<28} {:>10.3f} {:>10.3f} {:>12.1f} {:>16.1f} {:>12.1f}".format(
+            result["case"],
+            result["wall_seconds"],
+            result["cpu_seconds"],
+            result["peak_rss_bytes"] / 1024 / 1024,
+            result["bytes_read"] / 1024 / 1024,
+            result.get("disk_bytes_read", 0) / 1024 / 1024,
+        )
+        if baseline and result["case"] in baseline:
+            base = baseline[result["case"]]
+            line += " {:>10.2f} {:>10.2f}".format(
+                result["wall_seconds"] / max(base["wall_seconds"], 1e-9),
+                result["peak_rss_bytes"] / max(base["peak_rss_bytes"], 1),
+            )
+        print(line)
+    print()
+    print(
+        "[1] rchar: every read() in the case, including interpreter startup "
+        "reads it triggers (module imports) and page cache hits"
+    )
+    print("[2] read_bytes: what the case made the kernel fetch from storage")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        run_case_in_child(sys.argv[2], sys.argv[3], os.environ["BENCH_RESULT_FILE"])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the scanners and analyzers on synthetic data"
+    )
+    parser.add_argument(
+        "cases",
+        nargs="*",
+        help="cases to run (default: all of {})".format(", ".join(CASES)),
+    )
+    parser.add_argument("--files", type=int, default=5000, help="files in the tree")
+    parser.add_argument(
+        "--inventory-files",
+        type=int,
+        default=200000,
+        help="records in the synthetic inventories",
+    )
+    parser.add_argument("--dupe-ratio", type=float, default=0.3)
+    parser.add_argument("--depth", type=int, default=3, help="directory depth")
+    parser.add_argument("--width", type=int, default=4, help="subdirectories per dir")
+    parser.add_argument("--size-dist", choices=SIZE_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--mean-size", type=int, default=16 * 1024)
+    parser.add_argument("--max-size", type=int, default=16 * 1024 * 1024)
+    parser.add_argument("--non-utf8-ratio", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="keep the best of N runs")
+    parser.add_argument(
+        "--workdir", help="keep generated data here instead of a temporary directory"
+    )
+    parser.add_argument("--save", help="write results as JSON (a baseline)")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    args = parser.parse_args()
+
+    cases = args.cases or list(CASES)
+    for case in cases:
+        assert case in CASES, "Unknown case " + case
+    if importlib.util.find_spec("numpy") is None:
+        # NumPy is optional; only run its case when it is installed
+        for case in cases:
+            if case in NUMPY_CASES:
+                print("Skipping {} (NumPy is not installed)".format(case))
+        cases = [case for case in cases if case not in NUMPY_CASES]
+
+    def make_spec(files: int) -> SyntheticSpec:
+        return SyntheticSpec(
+            files,
+            args.dupe_ratio,
+            args.depth,
+            args.width,
+            args.size_dist,
+            args.mean_size,
+            args.max_size,
+            args.non_utf8_ratio,
+            args.seed,
+        )
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="dupe-finder-bench-")
+    try:
+        if not os.path.exists(os.path.join(workdir, "tree")):
+            prepare_workdir(
+                make_spec(args.files), make_spec(args.inventory_files), workdir
+            )
+        if not os.path.exists(os.path.join(workdir, "ref_hashes.txt.xz")):
+            prepare_compressed_inventories(workdir)
+
+        results = []
+        for case in cases:
+            print("Running {}...".format(case))
+            results.append(run_case(case, workdir, args.repeat))
+
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+        print_results(results, baseline)
+
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump({r["case"]: r for r in results}, f, indent=2)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
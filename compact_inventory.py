@@ -0,0 +1,173 @@
+import argparse
+import base64
+import os
+from typing import Dict, Iterator, List, Optional, Text, Tuple
+
+from external_sort import DEFAULT_MAX_LINES, external_sort
+from inventory_io import detect_compression, open_inventory, replace_inventory
+
+
+SORT_ORDERS = ("path", "digest")
+
+
+def encoding_of(path_bytes: bytes) -> Text:
+    try:
+        path_bytes.decode("utf-8", errors="strict")
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "unknown-encoding"
+
+
+def tagged_records(
+    inventory_file: Text, is_hashes: bool, problems: List[Tuple[Text, int]]
+) -> Iterator[Text]:
+    """Yield "<b64 path>  <line no>  <value>\\n" for each valid line, so that
+    sorting by (path, line no) puts the latest record of a path last."""
+    with open_inventory(inventory_file, "r") as file_handle:
+        line_no = 0
+        while True:
+            line = file_handle.readline()
+            if not line:
+                break
+
+            line_no += 1
+            parts = line.split("  ")
+            if len(parts) < 3:
+                problems.append((inventory_file, line_no))
+                continue
+            value = parts[0].strip()
+            if is_hashes and len(value) != 32:
+                problems.append((inventory_file, line_no))
+                continue
+            if not is_hashes and not value.isdigit():
+                problems.append((inventory_file, line_no))
+                continue
+            yield "{}  {}  {}\n".format(parts[2].strip(), line_no, value)
+
+
+def path_and_line_key(record: Text) -> Tuple[bytes, int]:
+    b64path, line_no, _ = record.split("  ", 2)
+    return base64.b64decode(b64path), int(line_no)
+
+
+def latest_records(
+    inventory_file: Text,
+    is_hashes: bool,
+    max_lines: int,
+    tmp_dir: Optional[Text],
+    stats: Dict[Text, int],
+) -> Iterator[Tuple[bytes, Text, Text]]:
+    """Yield (path, value, b64 path) for the last record of each path, in
+    path order."""
+    problems = []  # type: List[Tuple[Text, int]]
+    previous = None  # type: Optional[Tuple[bytes, Text, Text]]
+    for record in external_sort(
+        tagged_records(inventory_file, is_hashes, problems),
+        path_and_line_key,
+        max_lines,
+        tmp_dir,
+    ):
+        stats["read"] += 1
+        b64path, _, value = record.rstrip("\n").split("  ", 2)
+        path_bytes = base64.b64decode(b64path)
+        if previous is not None and previous[0] != path_bytes:
+            yield previous
+        previous = (path_bytes, value, b64path)
+    if previous is not None:
+        yield previous
+    stats["problems"] += len(problems)
+
+
+def compact(
+    inventory_file: Text,
+    output_file: Text,
+    is_hashes: bool,
+    sort_order: Text,
+    drop_missing: bool,
+    max_lines: int,
+    tmp_dir: Optional[Text],
+) -> Dict[Text, int]:
+    stats = {"read": 0, "written": 0, "dropped": 0, "problems": 0}
+
+    def lines() -> Iterator[Text]:
+        for path_bytes, value, b64path in latest_records(
+            inventory_file, is_hashes, max_lines, tmp_dir, stats
+        ):
+            if drop_missing and not os.path.lexists(path_bytes):
+                stats["dropped"] += 1
+                continue
+            yield "{}  {}  {}\n".format(value, encoding_of(path_bytes), b64path)
+
+    records = lines()  # type: Iterator[Text]
+    if is_hashes and sort_order == "digest":
+        # Already in path order, so equal digests stay sorted by path
+        records = external_sort(records, lambda line: line[:32], max_lines, tmp_dir)
+
+    # Write next to the output and rename, so compacting in place is safe.
+    # The output keeps the input's compression.
+    temp_output = output_file + ".compacting"
+    with open_inventory(
+        temp_output, "w", compression=detect_compression(inventory_file)
+    ) as output_handle:
+        for line in records:
+            output_handle.write(line)
+            stats["written"] += 1
+    replace_inventory(temp_output, output_file)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compact a hashes/sizes inventory: keep the latest record "
+        "per path, optionally drop deleted files, and sort the result"
+    )
+    parser.add_argument("hashes_file", help="hashes file path")
+    parser.add_argument("sizes_file", help="sizes file path")
+    parser.add_argument(
+        "-z", "--output-hashes", help="output hashes file (default: in place)"
+    )
+    parser.add_argument(
+        "-s", "--output-sizes", help="output sizes file (default: in place)"
+    )
+    parser.add_argument(
+        "--sort",
+        choices=SORT_ORDERS,
+        default="path",
+        help="order of the hashes file; the sizes file is always in path order",
+    )
+    parser.add_argument(
+        "-d",
+        "--drop-missing",
+        help="drop records for files that no longer exist",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-m",
+        "--max-lines",
+        type=int,
+        default=DEFAULT_MAX_LINES,
+        help="lines sorted in memory before spilling to disk",
+    )
+    parser.add_argument("--tmp-dir", help="directory for sort runs")
+    args = parser.parse_args()
+
+    for inventory_file, output_file, is_hashes in (
+        (args.hashes_file, args.output_hashes or args.hashes_file, True),
+        (args.sizes_file, args.output_sizes or args.sizes_file, False),
+    ):
+        print("Compacting {}...".format(inventory_file))
+        stats = compact(
+            inventory_file,
+            output_file,
+            is_hashes,
+            args.sort,
+            args.drop_missing,
+            args.max_lines,
+            args.tmp_dir,
+        )
+        print(
+            "Read {} records, wrote {} ({} for missing files dropped, "
+            "{} bad lines)".format(
+                stats["read"], stats["written"], stats["dropped"], stats["problems"]
+            )
+        )
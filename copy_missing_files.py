@@ -1,8 +1,122 @@
 import argparse
 import base64
-from os import makedirs, path
-from shutil import copy2
-from typing import Set
+import errno
+import fcntl
+import hashlib
+from os import getpid, link, makedirs, path, remove, replace
+from shutil import copy2, copystat
+from typing import Dict, Iterator, List, Optional, Set
+
+from inventory_io import open_inventory
+
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+CHUNK_SIZE = 1024 * 1024 * 32  # 32MB
+
+
+def read_hashes(hashes_file: str) -> Dict[bytes, str]:
+    """Map each path in a find_hashes_and_sizes.py hashes file to its digest."""
+    hashes = dict()  # type: Dict[bytes, str]
+    with open_inventory(hashes_file, "r") as hashes_file_handle:
+        while True:
+            line = hashes_file_handle.readline()
+            if not line:
+                break
+
+            parts = line.split("  ")
+            if len(parts) >= 3 and len(parts[0]) == 32:
+                hashes[base64.b64decode(parts[2])] = parts[0]
+    return hashes
+
+
+def hash_file(file_path: bytes) -> str:
+    hasher = hashlib.md5()
+    with open(file_path, "rb") as f:
+        while True:
+            buf = f.read(CHUNK_SIZE)
+            if not buf:
+                break
+            hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def reflink(existing: bytes, dest: bytes) -> bool:
+    """Clone existing into a new file at dest sharing its data blocks (FICLONE).
+
+    Returns False, leaving nothing behind, when the filesystem can't do it
+    (not btrfs/XFS/etc, or existing and dest are on different filesystems).
+    Other errors are raised, also leaving nothing behind.
+    """
+    failure = None  # type: Optional[OSError]
+    with open(existing, "rb") as src_handle:
+        with open(dest, "xb") as dest_handle:
+            try:
+                fcntl.ioctl(dest_handle.fileno(), FICLONE, src_handle.fileno())
+                return True
+            except OSError as error:
+                if error.errno not in (
+                    errno.EXDEV,
+                    errno.EOPNOTSUPP,
+                    errno.EINVAL,
+                    errno.ENOTTY,
+                    errno.EBADF,
+                ):
+                    failure = error
+    remove(dest)
+    if failure:
+        raise failure
+    return False
+
+
+def existing_copies(
+    digest: Optional[str],
+    size: int,
+    dest_by_hash: Dict[str, List[bytes]],
+    verified_digests: Dict[bytes, str],
+) -> Iterator[bytes]:
+    """Existing destination files with the given content, in inventory order.
+
+    The inventory may be stale, so each candidate is rehashed before it is
+    yielded; verified_digests caches the digest of each file read so far.
+    """
+    if not digest:
+        return
+    for existing in dest_by_hash.get(digest, []):
+        if not path.isfile(existing) or path.getsize(existing) != size:
+            continue
+        if existing not in verified_digests:
+            verified_digests[existing] = hash_file(existing)
+        if verified_digests[existing] == digest:
+            yield existing
+
+
+def link_existing(existing: bytes, dest: bytes, hardlink: bool, source: bytes) -> bool:
+    """Hardlink or clone existing to dest, replacing dest like copy2 would.
+
+    The link is made under a temporary name next to dest and renamed over
+    it. Returns False if this candidate can't be linked from (e.g. it is on
+    another filesystem), so the caller can try the next one.
+    """
+    temporary = path.join(path.dirname(dest), b".copy-missing-%d.tmp" % getpid())
+    if hardlink:
+        try:
+            link(existing, temporary)
+        except OSError as error:
+            # e.g. EXDEV across filesystems, EMLINK
+            print("Cannot link ({})".format(error))
+            return False
+    elif reflink(existing, temporary):
+        copystat(source, temporary)
+    else:
+        return False
+
+    try:
+        replace(temporary, dest)
+    except OSError:
+        remove(temporary)
+        raise
+    return True
 
 
 if __name__ == "__main__":
@@ -23,12 +137,45 @@ if __name__ == "__main__":
         help="write to stdout instead of copying",
         action="store_true",
     )
+    parser.add_argument(
+        "-z",
+        "--destination-hashes",
+        help="hashes file of the destination; content already there is "
+        "reflinked (or hardlinked) instead of copied",
+    )
+    parser.add_argument(
+        "-s",
+        "--source-hashes",
+        help="hashes file of the source, to look up digests of missing files "
+        "(otherwise they are hashed before copying)",
+    )
+    parser.add_argument(
+        "-l",
+        "--hardlink",
+        help="hardlink to existing content instead of reflinking (the copies "
+        "then share metadata and later edits)",
+        action="store_true",
+    )
     args = parser.parse_args()
 
     source_dir = path.normpath(args.source).encode("utf-8")
     destination_dir = path.abspath(args.destination).encode("utf-8")
     known_dirs = set()  # type: Set[bytes]
 
+    dest_by_hash = dict()  # type: Dict[str, List[bytes]]
+    verified_digests = dict()  # type: Dict[bytes, str]
+    source_hashes = dict()  # type: Dict[bytes, str]
+    if args.destination_hashes:
+        print("Reading destination hashes file...")
+        for file_path, dest_digest in read_hashes(args.destination_hashes).items():
+            dest_by_hash.setdefault(dest_digest, []).append(file_path)
+        if args.source_hashes:
+            print("Reading source hashes file...")
+            source_hashes = read_hashes(args.source_hashes)
+
+    copied_count = linked_count = 0
+    bytes_copied = bytes_avoided = 0
+
     with open(args.missing_files, "r", encoding="utf-8") as missing_items_file_handle:
         line_no = 0
         while True:
@@ -66,6 +213,16 @@ if __name__ == "__main__":
                     else:
                         needed_paths.append(parent)
 
+                size = path.getsize(missing_file_path)
+                digest = None  # type: Optional[str]
+                if args.destination_hashes:
+                    digest = source_hashes.get(missing_file_path)
+                    if not digest:
+                        digest = hash_file(missing_file_path)
+                candidates = existing_copies(
+                    digest, size, dest_by_hash, verified_digests
+                )
+
                 if args.dry_run:
                     needed_paths.reverse()
                     for needed_path in needed_paths:
@@ -74,14 +231,52 @@ if __name__ == "__main__":
                         print(needed_path.decode("utf-8", "ignore"))
                         print()
 
-                    print("COPY")
-                    print("FROM: " + missing_file_path.decode("utf-8", "ignore"))
+                    existing = next(candidates, None)
+                    if existing:
+                        print("HARDLINK" if args.hardlink else "REFLINK")
+                        print("FROM: " + existing.decode("utf-8", "ignore"))
+                    else:
+                        print("COPY")
+                        print("FROM: " + missing_file_path.decode("utf-8", "ignore"))
                     print("  TO: " + dest.decode("utf-8", "ignore"))
                     print()
                 else:
-                    print("Copying {}...".format(rel.decode("utf-8", "ignore")))
                     if needed_paths:
                         makedirs(needed_paths[0], exist_ok=False)
-                    copy2(missing_file_path, dest)  # type: ignore
+
+                    # dest's content is about to change if it was a candidate
+                    verified_digests.pop(dest, None)
+                    linked = False
+                    for existing in candidates:
+                        print(
+                            "{} {}...".format(
+                                "Linking" if args.hardlink else "Cloning",
+                                rel.decode("utf-8", "ignore"),
+                            )
+                        )
+                        linked = link_existing(
+                            existing, dest, args.hardlink, missing_file_path
+                        )
+                        if linked:
+                            break
+
+                    if linked:
+                        linked_count += 1
+                        bytes_avoided += size
+                    else:
+                        print("Copying {}...".format(rel.decode("utf-8", "ignore")))
+                        copy2(missing_file_path, dest)  # type: ignore
+                        copied_count += 1
+                        bytes_copied += size
+                        if digest:
+                            # Later missing files with this content can use it
+                            dest_by_hash.setdefault(digest, []).append(dest)
             except Exception as e:
                 print("problem on line {}: {}".format(line_no, e))
+
+    if not args.dry_run:
+        print(
+            "Copied {} files ({} bytes), linked {} files ({} bytes avoided)".format(
+                copied_count, bytes_copied, linked_count, bytes_avoided
+            )
+        )
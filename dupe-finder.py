@@ -1,13 +1,57 @@
 from __future__ import annotations
 
+import argparse
 from collections import defaultdict
+from contextlib import closing
 import hashlib
-from os import listdir, path, sep
+import heapq
+import math
+from os import fsencode, listdir, path, sep
+import random
 import sys
-from typing import Dict, List, Generator, Optional, Sequence, Set, Text, Tuple
+from typing import (
+    Dict,
+    Generic,
+    List,
+    Generator,
+    Optional,
+    Sequence,
+    Set,
+    Text,
+    Tuple,
+    TypeVar,
+)
 
 import attr
 
+from inventory_io import open_inventory
+import minhash
+from minhash import LSHIndex, MinHasher
+from out_of_core import (
+    DEFAULT_MEMORY_BUDGET,
+    file_dupes_out_of_core,
+    max_lines_for,
+    parse_size,
+)
+from profiling import (
+    NULL_PROFILER,
+    NullProfiler,
+    add_profiling_arguments,
+    profiler_from_args,
+)
+from read_engine import ReadEngine
+
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+HEAD_HASH_BYTES = 64 * 1024
+CHUNK_SIZE = 1024 * 1024 * 32  # 32MB
+# Full hashes stream through this instead of reading whole files into memory
+READ_ENGINE = ReadEngine(CHUNK_SIZE)
+# Two-sided 95% normal quantile
+Z_95 = 1.959964
+
 
 @attr.s
 class File:
@@ -17,6 +61,8 @@ class File:
     md5_hash_cache = attr.ib(type=Optional[int], default=None)
     parent_dir = attr.ib(type=Optional["Directory"], default=None)
     duplicates = attr.ib(type=Optional[Sequence["File"]], default=None)
+    # A duplicate lives outside this file's directory's subtree
+    copied_elsewhere = attr.ib(type=bool, default=False)
 
     @classmethod
     def populate(cls, name: Text, absolute_path: Text) -> "File":
@@ -36,11 +82,23 @@ class File:
             return self.md5_hash_cache
 
         hasher = hashlib.md5()
-        hasher.update(self.data)
+        with closing(READ_ENGINE.chunks(fsencode(self.absolute_path))) as chunks:
+            for chunk in chunks:
+                hasher.update(chunk)
         hex_digest = hasher.hexdigest()
         self.md5_hash_cache = int(hex_digest, 16)
         return self.md5_hash_cache
 
+    def head_hash(self, length: int) -> int:
+        """MD5 of the first length bytes; for files no longer than that it is
+        the full hash, which gets cached too."""
+        with open(self.absolute_path, "rb") as f:
+            head = f.read(length)
+        head_hash = int(hashlib.md5(head).hexdigest(), 16)
+        if self.size <= length:
+            self.md5_hash_cache = head_hash
+        return head_hash
+
 
 @attr.s
 class Directory:
@@ -51,78 +109,201 @@ class Directory:
     contained_hashes_cache = attr.ib(type=Optional[Set[int]], default=None)
     parent_dir = attr.ib(type=Optional["Directory"], default=None)
     entirely_duplicated_cache = attr.ib(type=Optional[bool], default=None)
+    fingerprint_cache = attr.ib(type=Optional[bytes], default=None)
+    content_fingerprint_cache = attr.ib(type=Optional[bytes], default=None)
+    minhash_cache = attr.ib(type=Optional[List[int]], default=None)
+    # Subtree totals, filled in by compute_rollups
+    total_bytes = attr.ib(type=int, default=0)
+    file_count = attr.ib(type=int, default=0)
+    dupe_bytes = attr.ib(type=int, default=0)
+    dupe_count = attr.ib(type=int, default=0)
+    uncopied_count = attr.ib(type=int, default=0)
+    # Position in a preorder numbering of the tree, filled in by index_preorder;
+    # the subtree of this directory is numbered [preorder_index, subtree_end)
+    preorder_index = attr.ib(type=Optional[int], default=None)
+    subtree_end = attr.ib(type=Optional[int], default=None)
 
     @property
     def contained_hashes(self) -> Set[int]:
-        if self.contained_hashes_cache is not None:
-            return self.contained_hashes_cache
-        else:
-            self.contained_hashes_cache = {
-                file.md5_hash for file in self.files if file.md5_hash
-            }
-            for subdirectory in self.subdirectories:
-                self.contained_hashes_cache.update(subdirectory.contained_hashes)
+        if self.contained_hashes_cache is None:
+            for directory in self.get_directories_post_order():
+                if directory.contained_hashes_cache is not None:
+                    continue
+                hashes = {file.md5_hash for file in directory.files if file.md5_hash}
+                for subdirectory in directory.subdirectories:
+                    assert subdirectory.contained_hashes_cache is not None
+                    hashes.update(subdirectory.contained_hashes_cache)
+                directory.contained_hashes_cache = hashes
 
-            return self.contained_hashes_cache
+        assert self.contained_hashes_cache is not None
+        return self.contained_hashes_cache
 
     @property
     def is_entirely_duplicated(self) -> bool:
-        if self.entirely_duplicated_cache is not None:
-            return self.entirely_duplicated_cache
-        else:
-            self.entirely_duplicated_cache = self._compute_is_entirely_duplicated()
-            return self.entirely_duplicated_cache
+        """Every file below has a copy outside its own directory's subtree
+        (see File.copied_elsewhere); read from the rollups."""
+        if self.entirely_duplicated_cache is None:
+            self.compute_rollups()
+        assert self.entirely_duplicated_cache is not None
+        return self.entirely_duplicated_cache
+
+    def compute_rollups(self) -> None:
+        """Fill in subtree totals for this directory and everything below it
+        in a single post-order pass."""
+        pending = [(self, False)]  # type: List[Tuple[Directory, bool]]
+        while pending:
+            directory, children_done = pending.pop()
+            if not children_done:
+                pending.append((directory, True))
+                pending.extend((sub, False) for sub in directory.subdirectories)
+                continue
+
+            total_bytes = file_count = dupe_bytes = dupe_count = uncopied_count = 0
+            for file in directory.files:
+                total_bytes += file.size
+                file_count += 1
+                if file.duplicates:
+                    dupe_bytes += file.size
+                    dupe_count += 1
+                if not file.copied_elsewhere:
+                    uncopied_count += 1
+            for subdirectory in directory.subdirectories:
+                total_bytes += subdirectory.total_bytes
+                file_count += subdirectory.file_count
+                dupe_bytes += subdirectory.dupe_bytes
+                dupe_count += subdirectory.dupe_count
+                uncopied_count += subdirectory.uncopied_count
+
+            directory.total_bytes = total_bytes
+            directory.file_count = file_count
+            directory.dupe_bytes = dupe_bytes
+            directory.dupe_count = dupe_count
+            directory.uncopied_count = uncopied_count
+            directory.entirely_duplicated_cache = uncopied_count == 0
+
+    def fingerprint(self, ignore_names: bool = False) -> bytes:
+        """Merkle digest of this subtree, built bottom-up from sorted children.
+
+        Two directories have the same fingerprint exactly when their trees
+        hold the same files (by content) under the same names. With
+        ignore_names, only contents and shape count, so renamed copies match.
+        """
+        cached = self._cached_fingerprint(ignore_names)
+        if cached is not None:
+            return cached
+
+        for directory in self.get_directories_post_order():
+            if directory._cached_fingerprint(ignore_names) is not None:
+                continue
 
-    def _compute_is_entirely_duplicated(self) -> bool:
-        for file in self.files:
-            if not file.duplicates:
-                return False
+            entries = []  # type: List[bytes]
+            for file in directory.files:
+                digest = file.md5_hash.to_bytes(16, "big")
+                if ignore_names:
+                    entries.append(b"f" + digest)
+                else:
+                    entries.append(b"f" + _encode_name(file.name) + b"\0" + digest)
+            for subdirectory in directory.subdirectories:
+                subtree = subdirectory._cached_fingerprint(ignore_names)
+                assert subtree is not None
+                if ignore_names:
+                    entries.append(b"d" + subtree)
+                else:
+                    entries.append(
+                        b"d" + _encode_name(subdirectory.name) + b"\0" + subtree
+                    )
+
+            hasher = hashlib.md5()
+            for entry in sorted(entries):
+                hasher.update(entry)
+            if ignore_names:
+                directory.content_fingerprint_cache = hasher.digest()
+            else:
+                directory.fingerprint_cache = hasher.digest()
+
+        fingerprint = self._cached_fingerprint(ignore_names)
+        assert fingerprint is not None
+        return fingerprint
 
-            if all([f.parent_dir == self for f in file.duplicates]):
-                # unique file with only duplicates here
-                return False
+    def _cached_fingerprint(self, ignore_names: bool) -> Optional[bytes]:
+        if ignore_names:
+            return self.content_fingerprint_cache
+        return self.fingerprint_cache
 
-            if all([self.contains_recursive(f) for f in file.duplicates]):
-                # It doesn't exist outside this subtree,
-                # so we can't say this dir is entirely duped
-                return False
+    def minhash(self, hasher: MinHasher) -> List[int]:
+        """MinHash sketch of the set of file digests in this subtree."""
+        if self.minhash_cache is not None:
+            return self.minhash_cache
 
-        for subdirectory in self.subdirectories:
-            if not subdirectory.is_entirely_duplicated:
-                return False
+        for directory in self.get_directories_post_order():
+            if directory.minhash_cache is not None:
+                continue
+            sketch = hasher.sketch(file.md5_hash for file in directory.files)
+            for subdirectory in directory.subdirectories:
+                assert subdirectory.minhash_cache is not None
+                sketch = minhash.merge(sketch, subdirectory.minhash_cache)
+            directory.minhash_cache = sketch
 
-        return True
+        assert self.minhash_cache is not None
+        return self.minhash_cache
+
+    def index_preorder(self) -> None:
+        """Number this tree in preorder so is_ancestor_of takes O(1). Call it
+        once the tree is complete; adding directories afterwards leaves the
+        numbering stale."""
+        directories = list(self.get_directories_recursive())
+        for index, directory in enumerate(directories):
+            directory.preorder_index = index
+        for directory in reversed(directories):
+            assert directory.preorder_index is not None
+            directory.subtree_end = max(
+                [directory.preorder_index + 1]
+                + [sub.subtree_end or 0 for sub in directory.subdirectories]
+            )
+
+    def is_ancestor_of(self, directory: "Directory") -> bool:
+        if (
+            self.preorder_index is not None
+            and self.subtree_end is not None
+            and directory.preorder_index is not None
+        ):
+            return self.preorder_index < directory.preorder_index < self.subtree_end
+        for ancestor in directory.get_parents_recursive():
+            if ancestor is self:
+                return True
+        return False
 
     def contains_recursive(self, file: File) -> bool:
-        if file.parent_dir == self:
-            return True
-        for subdirectory in self.subdirectories:
-            if subdirectory.contains_recursive(file):
+        directory = file.parent_dir
+        while directory is not None:
+            if directory is self:
                 return True
+            directory = directory.parent_dir
         return False
 
     @classmethod
     def populate(cls, absolute_path: Text, name: Optional[Text] = None) -> "Directory":
-        files = []  # type: List[File]
-        subdirectories = []  # type: List[Directory]
-
-        fs_items = [Text(i) for i in listdir(absolute_path) if not i.startswith(".")]
-        for fs_item in fs_items:
-            item_path = path.join(absolute_path, fs_item)
-            if path.isdir(item_path):
-                subdir = cls.populate(item_path, fs_item)
-                subdirectories.append(subdir)
-            else:
-                file = File.populate(item_path, fs_item)
-                files.append(file)
-
         dir_name = name or path.dirname(absolute_path)
-        dir = Directory(dir_name, absolute_path, files, subdirectories)
-        for file in files:
-            file.parent_dir = dir
-        for subdir in subdirectories:
-            subdir.parent_dir = dir
-        return dir
+        root_dir = Directory(dir_name, absolute_path, [], [])
+
+        # Explicit stack so that deep trees don't hit the recursion limit
+        pending = [root_dir]
+        while pending:
+            dir = pending.pop()
+            fs_items = [
+                Text(i) for i in listdir(dir.absolute_path) if not i.startswith(".")
+            ]
+            for fs_item in fs_items:
+                item_path = path.join(dir.absolute_path, fs_item)
+                if path.isdir(item_path):
+                    subdir = Directory(fs_item, item_path, [], [], parent_dir=dir)
+                    dir.subdirectories.append(subdir)
+                    pending.append(subdir)
+                else:
+                    file = File.populate(fs_item, item_path)
+                    file.parent_dir = dir
+                    dir.files.append(file)
+        return root_dir
 
     @classmethod
     def populate_from_records(
@@ -133,7 +314,7 @@ class Directory:
         current_dir = root_dir
 
         hashes = {}  # Dict[Text, int]
-        with open(hashes_file, errors="replace") as file_in:
+        with open_inventory(hashes_file, "r", errors="replace") as file_in:
             for line_no, line in enumerate(file_in, 1):
                 hex_digest, _, file_path = (
                     line.strip().replace("\t", " ").partition(" ")
@@ -150,7 +331,7 @@ class Directory:
                     )
                     continue
 
-        with open(sizes_file, errors="replace") as file_in:
+        with open_inventory(sizes_file, "r", errors="replace") as file_in:
             for line_no, line in enumerate(file_in, 1):
                 size_str, _, file_path = line.strip().replace("\t", " ").partition(" ")
                 norm_path = path.normpath(file_path)
@@ -186,7 +367,7 @@ class Directory:
         root_dir = Directory(dir_name, absolute_path, [], [])
         current_dir = root_dir
 
-        with open(hashes_file, errors="replace") as file_in:
+        with open_inventory(hashes_file, "r", errors="replace") as file_in:
             for line_no, line in enumerate(file_in, 1):
                 sys.stderr.write("Reading line {}\r".format(line_no))
 
@@ -216,17 +397,28 @@ class Directory:
         return root_dir
 
     def get_files_recursive(self) -> Generator[File, None, None]:
-        for file in self.files:
-            yield file
-        for subdirectory in self.subdirectories:
-            for file in subdirectory.get_files_recursive():
-                yield file
+        for directory in self.get_directories_recursive():
+            yield from directory.files
+
+    def get_directories_recursive(self) -> Generator["Directory", None, None]:
+        """This directory and every one below it, in preorder."""
+        pending = [self]
+        while pending:
+            directory = pending.pop()
+            yield directory
+            pending.extend(reversed(directory.subdirectories))
+
+    def get_directories_post_order(self) -> List["Directory"]:
+        """This directory and every one below it, each after its children."""
+        directories = list(self.get_directories_recursive())
+        directories.reverse()
+        return directories
 
     def get_parents_recursive(self) -> Generator["Directory", None, None]:
-        if self.parent_dir:
-            yield self.parent_dir
-            for ancestor in self.parent_dir.get_parents_recursive():
-                yield ancestor
+        ancestor = self.parent_dir
+        while ancestor is not None:
+            yield ancestor
+            ancestor = ancestor.parent_dir
 
     def recursive_make(self, full_path: Text) -> "Directory":
         if self.absolute_path == full_path:
@@ -244,126 +436,605 @@ class Directory:
     def recursive_make_with_components(
         self, missing_components: List[Text]
     ) -> "Directory":
-        if len(missing_components) == 0:
-            return self
+        directory = self
+        for subdir_name in missing_components:
+            for subdirectory in directory.subdirectories:
+                if subdirectory.name == subdir_name:
+                    directory = subdirectory
+                    break
+            else:
+                subdir_path = path.join(directory.absolute_path, subdir_name)
+                new_dir = Directory(subdir_name, subdir_path, [], [])
+                directory.subdirectories.append(new_dir)
+                new_dir.parent_dir = directory
+                directory = new_dir
+        return directory
 
-        for subdirectory in self.subdirectories:
-            if subdirectory.name == missing_components[0]:
-                return subdirectory.recursive_make_with_components(
-                    missing_components[1:]
-                )
 
-        subdir_name = missing_components[0]
-        subdir_path = path.join(self.absolute_path, subdir_name)
-        new_dir = Directory(subdir_name, subdir_path, [], [])
-        self.subdirectories.append(new_dir)
-        new_dir.parent_dir = self
-        return new_dir.recursive_make_with_components(missing_components[1:])
+class TopK(Generic[K, V]):
+    """Keeps the limit largest items by key, or every item if limit is None."""
+
+    def __init__(self, limit: Optional[int] = None) -> None:
+        self.limit = limit
+        self.heap = []  # type: List[Tuple[K, int, V]]
+        self.pushed = 0
+
+    def push(self, key: K, item: V) -> None:
+        # The counter breaks ties so items themselves are never compared
+        entry = (key, self.pushed, item)
+        self.pushed += 1
+        if self.limit is None:
+            self.heap.append(entry)
+        elif len(self.heap) < self.limit:
+            heapq.heappush(self.heap, entry)
+        elif self.limit and key > self.heap[0][0]:  # type: ignore
+            heapq.heapreplace(self.heap, entry)
+
+    def largest(self) -> List[Tuple[K, V]]:
+        entries = sorted(self.heap, key=lambda e: (e[0], -e[1]), reverse=True)
+        return [(key, item) for key, _, item in entries]
+
+
+def _common_ancestor(directories: List[Directory]) -> Directory:
+    """Deepest directory containing all of the given ones."""
+    chain = [directories[0]] + list(directories[0].get_parents_recursive())
+    positions = {id(directory): index for index, directory in enumerate(chain)}
+    deepest = 0
+    for directory in directories[1:]:
+        ancestor = directory  # type: Optional[Directory]
+        while ancestor is not None and id(ancestor) not in positions:
+            ancestor = ancestor.parent_dir
+        assert ancestor is not None, "Directories are not in one tree"
+        deepest = max(deepest, positions[id(ancestor)])
+    return chain[deepest]
+
+
+def _encode_name(name: Text) -> bytes:
+    return name.encode("utf-8", "surrogateescape")
+
+
+def identical_trees(
+    root_dir: Directory, ignore_names: bool = False
+) -> List[List[Directory]]:
+    """Group directories whose whole subtrees are identical.
+
+    One pass buckets every directory by fingerprint. A group is dropped when
+    its members' parents are distinct and together form exactly one group of
+    the same size, since that group already accounts for every member. Groups
+    with two members under one parent are kept even when the parent is
+    duplicated. Empty trees are ignored.
+    """
+    directories_by_fingerprint = defaultdict(list)  # type: Dict[bytes, List[Directory]]
+    pending = [root_dir]
+    while pending:
+        directory = pending.pop()
+        directories_by_fingerprint[directory.fingerprint(ignore_names)].append(
+            directory
+        )
+        pending.extend(directory.subdirectories)
+
+    groups = []  # type: List[List[Directory]]
+    for directories in directories_by_fingerprint.values():
+        if len(directories) < 2:
+            continue
+        if next(directories[0].get_files_recursive(), None) is None:
+            continue
+        parents = {id(d.parent_dir): d.parent_dir for d in directories}
+        parent_fingerprints = {
+            parent.fingerprint(ignore_names) if parent else None
+            for parent in parents.values()
+        }
+        if len(parents) == len(directories) and len(parent_fingerprints) == 1:
+            parent_fingerprint = parent_fingerprints.pop()
+            if parent_fingerprint is not None and len(
+                directories_by_fingerprint[parent_fingerprint]
+            ) == len(directories):
+                continue
+        groups.append(directories)
+    return groups
+
+
+def similar_directories(
+    root_dir: Directory, threshold: float, num_perm: int = minhash.DEFAULT_NUM_PERM
+) -> List[Tuple[float, Directory, Directory]]:
+    """Find pairs of directories whose sets of file digests have an estimated
+    Jaccard similarity of at least threshold, using MinHash and LSH.
+
+    Pairs where one directory contains the other are skipped, as are pairs
+    whose parents already form a similar pair.
+    """
+    hasher = MinHasher(num_perm)
+    index = LSHIndex(num_perm, threshold)
+    root_dir.index_preorder()
+    directories = []  # type: List[Directory]
+    pending = [root_dir]
+    while pending:
+        directory = pending.pop()
+        pending.extend(directory.subdirectories)
+        sketch = directory.minhash(hasher)
+        if minhash.is_empty(sketch):
+            continue
+        index.add(sketch)
+        directories.append(directory)
+
+    pairs = []  # type: List[Tuple[float, Directory, Directory]]
+    for similarity, first, second in index.similar_pairs():
+        dir_a, dir_b = directories[first], directories[second]
+        if dir_a.is_ancestor_of(dir_b) or dir_b.is_ancestor_of(dir_a):
+            continue
+        pairs.append((similarity, dir_a, dir_b))
+
+    # Keep the highest-level match: drop a pair when a parent pair matches,
+    # or when one side also matches an ancestor of the other at least as well
+    similarity_by_pair = dict()  # type: Dict[Tuple[int, int], float]
+    for similarity, dir_a, dir_b in pairs:
+        similarity_by_pair[(id(dir_a), id(dir_b))] = similarity
+        similarity_by_pair[(id(dir_b), id(dir_a))] = similarity
+
+    def covered(similarity: float, dir_a: Directory, dir_b: Directory) -> bool:
+        if dir_a.parent_dir and dir_b.parent_dir:
+            if (id(dir_a.parent_dir), id(dir_b.parent_dir)) in similarity_by_pair:
+                return True
+        for ancestor in dir_b.get_parents_recursive():
+            if similarity_by_pair.get((id(dir_a), id(ancestor)), -1) >= similarity:
+                return True
+        for ancestor in dir_a.get_parents_recursive():
+            if similarity_by_pair.get((id(ancestor), id(dir_b)), -1) >= similarity:
+                return True
+        return False
+
+    return [pair for pair in pairs if not covered(*pair)]
+
+
+@attr.s
+class Estimate:
+    value = attr.ib(type=float)
+    variance = attr.ib(type=float)
+
+    @property
+    def margin(self) -> float:
+        return Z_95 * math.sqrt(self.variance)
+
+    def describe(self, unit: Text) -> Text:
+        return "{:,.0f} {} +/- {:,.0f} (95% CI {:,.0f} to {:,.0f})".format(
+            self.value,
+            unit,
+            self.margin,
+            max(0.0, self.value - self.margin),
+            self.value + self.margin,
+        )
+
+
+def _bucket_duplicates(files: List[File]) -> Tuple[int, int, int]:
+    """Resolve one size bucket: cheap head hashes first, full hashes only
+    where heads collide. Returns (duplicate files, redundant bytes, bytes
+    read)."""
+    size = files[0].size
+    head_length = min(size, HEAD_HASH_BYTES)
+    bytes_read = 0
+    files_by_head = defaultdict(list)  # type: Dict[int, List[File]]
+    for file in files:
+        files_by_head[file.head_hash(HEAD_HASH_BYTES)].append(file)
+        bytes_read += head_length
+
+    dupe_files = 0
+    redundant_bytes = 0
+    for same_head in files_by_head.values():
+        if len(same_head) < 2:
+            continue
+        files_by_hash = defaultdict(int)  # type: Dict[int, int]
+        for file in same_head:
+            if size > HEAD_HASH_BYTES:
+                bytes_read += size
+            files_by_hash[file.md5_hash] += 1
+        for count in files_by_hash.values():
+            if count > 1:
+                dupe_files += count
+                redundant_bytes += size * (count - 1)
+    return dupe_files, redundant_bytes, bytes_read
+
+
+def estimate_dupes(
+    root_path: Text,
+    sample_rate: float,
+    seed: Optional[int] = None,
+    profiler: NullProfiler = NULL_PROFILER,
+) -> None:
+    """Estimate how many files and bytes are duplicated while reading only a
+    sample of the data.
+
+    Only files sharing a size can be duplicates, so after the walk each size
+    bucket with two or more files is kept independently with probability
+    sample_rate and resolved exactly. The Horvitz-Thompson estimator scales
+    the sampled totals by 1 / sample_rate; for this Poisson sampling design
+    its variance is estimated by (1 - r) / r^2 times the sum of squared
+    bucket totals.
+    """
+    assert 0 < sample_rate <= 1, "Sample rate must be in (0, 1]"
+    rng = random.Random(seed)
+    out = sys.stdout
+
+    with profiler.phase("load tree"):
+        root_dir = Directory.populate(path.abspath(root_path))
+
+    with profiler.phase("group by size"):
+        files_by_size = defaultdict(list)  # type: Dict[int, List[File]]
+        total_files = 0
+        total_bytes = 0
+        for file in root_dir.get_files_recursive():
+            files_by_size[file.size].append(file)
+            total_files += 1
+            total_bytes += file.size
+
+    with profiler.phase("sample buckets"):
+        candidate_buckets = 0
+        sampled_buckets = 0
+        bytes_read = 0
+        sums = [0.0, 0.0]
+        squares = [0.0, 0.0]
+        for files in files_by_size.values():
+            if len(files) < 2:
+                continue
+            candidate_buckets += 1
+            if rng.random() >= sample_rate:
+                continue
+            sampled_buckets += 1
+            dupe_files, redundant_bytes, bucket_bytes_read = _bucket_duplicates(files)
+            bytes_read += bucket_bytes_read
+            for index, total in enumerate((dupe_files, redundant_bytes)):
+                sums[index] += total
+                squares[index] += total * total
+
+    scale = (1 - sample_rate) / (sample_rate * sample_rate)
+    dupe_files_estimate, redundant_bytes_estimate = [
+        Estimate(sums[index] / sample_rate, scale * squares[index])
+        for index in range(2)
+    ]
+
+    out.write("--- ESTIMATE ---\n")
+    out.write(
+        "Walked {} files ({} bytes) in {} sizes; {} sizes are shared by more "
+        "than one file\n".format(
+            total_files, total_bytes, len(files_by_size), candidate_buckets
+        )
+    )
+    out.write(
+        "Sampled {} of them at rate {}, reading {} bytes ({:.2%} of the data)\n".format(
+            sampled_buckets,
+            sample_rate,
+            bytes_read,
+            bytes_read / total_bytes if total_bytes else 0,
+        )
+    )
+    out.write("Duplicate files: {}\n".format(dupe_files_estimate.describe("files")))
+    out.write(
+        "Redundant bytes: {}\n".format(redundant_bytes_estimate.describe("bytes"))
+    )
+
+    profiler.print_summary()
 
 
 def file_dupes(
-    root_path: Text, hashes_file: Optional[Text], sizes_file: Optional[Text]
+    root_path: Text,
+    hashes_file: Optional[Text],
+    sizes_file: Optional[Text],
+    profiler: NullProfiler = NULL_PROFILER,
+    find_identical_trees: bool = False,
+    ignore_names: bool = False,
+    similarity_threshold: Optional[float] = None,
+    top: Optional[int] = None,
+    min_size: int = 0,
+    engine: Text = "python",
 ) -> None:
+    """Print duplicate files and entirely duplicated directories.
+
+    With top, only the top largest duplicate groups and directories are kept
+    (in a bounded heap) and reported; min_size drops smaller ones. The numpy
+    engine finds the same groups with vectorized sorts instead of dicts, and
+    for hashes and sizes files alone works on arrays without building the
+    tree (see numpy_engine.file_dupes_records).
+    """
     absolute_path = path.abspath(root_path)
+    out = sys.stdout
 
-    if hashes_file and sizes_file:
-        root_dir = Directory.populate_from_records(root_path, hashes_file, sizes_file)
-    elif hashes_file:
-        root_dir = Directory.populate_from_hashes(root_path, hashes_file)
-    else:
-        root_dir = Directory.populate(absolute_path)
+    if (
+        engine == "numpy"
+        and hashes_file
+        and sizes_file
+        and not find_identical_trees
+        and similarity_threshold is None
+    ):
+        # Nothing else needs the tree, so skip building it
+        import numpy_engine
 
-    # Group files by size
-    files_by_size = defaultdict(list)
-    for file in root_dir.get_files_recursive():
-        files_by_size[file.size].append(file)
+        numpy_engine.file_dupes_records(
+            root_path, hashes_file, sizes_file, profiler, top, min_size
+        )
+        return
 
-    # Group files by hash when same-sized files are found
-    files_by_hash = defaultdict(list)
-    for _, files in files_by_size.items():
-        if len(files) < 2:
-            continue
-        for file in files:
-            files_by_hash[file.md5_hash].append(file)
+    with profiler.phase("load tree"):
+        if hashes_file and sizes_file:
+            root_dir = Directory.populate_from_records(
+                root_path, hashes_file, sizes_file
+            )
+        elif hashes_file:
+            root_dir = Directory.populate_from_hashes(root_path, hashes_file)
+        else:
+            root_dir = Directory.populate(absolute_path)
+
+    if engine == "numpy":
+        import numpy_engine
+
+        with profiler.phase("hash and group"):
+            all_files = list(root_dir.get_files_recursive())
+            order, ranges = numpy_engine.duplicate_groups(
+                [file.size for file in all_files],
+                lambda indices: numpy_engine.digest_lanes(
+                    [all_files[index].md5_hash for index in indices.tolist()]
+                ),
+            )
+            files_by_hash = dict()  # type: Dict[int, List[File]]
+            for start, end in ranges:
+                files = [all_files[index] for index in order[start:end]]
+                files_by_hash[files[0].md5_hash] = files
+            del all_files, order, ranges
+    else:
+        # Group files by size
+        with profiler.phase("group by size"):
+            files_by_size = defaultdict(list)
+            for file in root_dir.get_files_recursive():
+                files_by_size[file.size].append(file)
+
+        # Group files by hash when same-sized files are found
+        with profiler.phase("hash and group"):
+            files_by_hash = defaultdict(list)
+            for _, files in files_by_size.items():
+                if len(files) < 2:
+                    continue
+                for file in files:
+                    files_by_hash[file.md5_hash].append(file)
 
-    # Release some memory
-    files_by_size.clear()
+            # Release some memory
+            files_by_size.clear()
 
     # Find duplicate files
-    dirs_with_dupes = dict()  # type: Dict[Text, Directory]
-    duplicates_by_size_and_hash = defaultdict(
-        list
-    )  # type: Dict[Tuple[int, int], List[File]]
-    for _, files in files_by_hash.items():
-        if len(files) < 2:
-            continue
-        for file in files:
-            file.duplicates = files
+    with profiler.phase("link dupes"):
+        dupe_groups = TopK(top)  # type: TopK[Tuple[int, int], List[File]]
+        for hash, files in files_by_hash.items():
+            if len(files) < 2:
+                continue
+            parent_dirs = []  # type: List[Directory]
+            for file in files:
+                file.duplicates = files
 
-            assert file.parent_dir, "Found orphaned file"
-            dirs_with_dupes[file.parent_dir.absolute_path] = file.parent_dir
-            for parent in file.parent_dir.get_parents_recursive():
-                dirs_with_dupes[parent.absolute_path] = parent
+                assert file.parent_dir, "Found orphaned file"
+                parent_dirs.append(file.parent_dir)
 
-            key = (file.size, file.md5_hash)
-            duplicates_by_size_and_hash[key].append(file)
+            # Unless all copies share one directory's subtree, each copy has
+            # one outside the subtree of any directory below their common one
+            common_dir = _common_ancestor(parent_dirs)
+            for file in files:
+                file.copied_elsewhere = file.parent_dir is not common_dir
 
-    # Release some memory
-    files_by_hash.clear()
+            if files[0].size >= min_size:
+                dupe_groups.push((files[0].size, hash), files)
+
+        # Release some memory
+        files_by_hash.clear()
+
+    with profiler.phase("roll up directories"):
+        root_dir.compute_rollups()
 
     # Print duplicate files in order by size, but skip if we don't
     # know anything about sizes, because it is useless that way
     if not (hashes_file and not sizes_file):
-        print("------ FILES ------")
-        dupe_keys = sorted(duplicates_by_size_and_hash, reverse=True)
-        for key in dupe_keys:
-            size, hash = key
-            files = duplicates_by_size_and_hash[key]
-            print(
-                "{} bytes ({}): \n{}\n".format(
-                    size, hash, ", ".join([file.absolute_path for file in files])
+        with profiler.phase("report files"):
+            out.write("------ FILES ------\n")
+            for (size, hash), files in dupe_groups.largest():
+                out.write("{} bytes ({}): \n".format(size, hash))
+                for index, file in enumerate(files):
+                    if index:
+                        out.write(", ")
+                    out.write(file.absolute_path)
+                out.write("\n\n")
+
+    # Find entirely duplicated directories
+    with profiler.phase("entirely duplicated"):
+        dupe_directories = TopK(top)  # type: TopK[int, Directory]
+        for directory in root_dir.get_directories_recursive():
+            if (
+                directory.dupe_count
+                and directory.is_entirely_duplicated
+                and (
+                    not directory.parent_dir
+                    or not directory.parent_dir.is_entirely_duplicated
                 )
-            )
+            ):
+                if hashes_file and not sizes_file:
+                    total_size = directory.file_count
+                else:
+                    total_size = directory.total_bytes
+                    if total_size < min_size:
+                        continue
+                dupe_directories.push(total_size, directory)
 
     # Print entirely duplicated directories
-    print("--- DIRECTORIES ---")
-    directories_and_sizes = list()  # type: List[Tuple[int, Directory]]
-    for directory in dirs_with_dupes.values():
-        if directory.is_entirely_duplicated and (
-            not directory.parent_dir or not directory.parent_dir.is_entirely_duplicated
-        ):
+    with profiler.phase("report directories"):
+        out.write("--- DIRECTORIES ---\n")
+        for total_size, directory in dupe_directories.largest():
             if hashes_file and not sizes_file:
-                total_size = len(list(directory.get_files_recursive()))
+                out.write(
+                    "{} entirely duplicated ({} files)\n".format(
+                        directory.absolute_path, total_size
+                    )
+                )
             else:
-                total_size = sum([f.size for f in directory.get_files_recursive()])
-            directories_and_sizes.append((total_size, directory))
-    for total_size, directory in sorted(directories_and_sizes, reverse=True):
-        if hashes_file and not sizes_file:
-            num_files = len(list(directory.get_files_recursive()))
-            print(
-                "{} entirely duplicated ({} files)".format(
-                    directory.absolute_path, num_files
+                out.write(
+                    "{} entirely duplicated ({} bytes)\n".format(
+                        directory.absolute_path, total_size
+                    )
                 )
-            )
-        else:
-            print(
-                "{} entirely duplicated ({} bytes)".format(
-                    directory.absolute_path, total_size
+
+    if find_identical_trees:
+        with profiler.phase("identical trees"):
+            print("--- IDENTICAL TREES ---")
+            groups_and_sizes = list()  # type: List[Tuple[int, List[Directory]]]
+            for directories in identical_trees(root_dir, ignore_names):
+                if hashes_file and not sizes_file:
+                    total_size = directories[0].file_count
+                else:
+                    total_size = directories[0].total_bytes
+                groups_and_sizes.append((total_size, directories))
+            groups_and_sizes.sort(key=lambda item: item[0], reverse=True)
+            for total_size, directories in groups_and_sizes:
+                unit = "files" if hashes_file and not sizes_file else "bytes"
+                print(
+                    "{} {} each: \n{}\n".format(
+                        total_size,
+                        unit,
+                        ", ".join([d.absolute_path for d in directories]),
+                    )
+                )
+
+    if similarity_threshold is not None:
+        with profiler.phase("similar directories"):
+            print("--- SIMILAR DIRECTORIES ---")
+            for similarity, dir_a, dir_b in similar_directories(
+                root_dir, similarity_threshold
+            ):
+                print(
+                    "{:.0%} similar: \n{}, {}\n".format(
+                        similarity, dir_a.absolute_path, dir_b.absolute_path
+                    )
                 )
-            )
+
+    profiler.print_summary()
 
 
 if __name__ == "__main__":
-    usage = "Usage: dupe-finder.py <top-level dir> <hashes file> <sizes file>"
-    assert len(sys.argv) in (2, 3, 4), usage
+    parser = argparse.ArgumentParser(description="Find duplicate files and directories")
+    parser.add_argument("root_dir", help="top-level directory")
     # Hashes file: `file: find / -type f -exec md5sum {} \; > hashes_file.txt `
     # Sizes file:  `file: find / -type f -exec du -b {} \; > sizes_file.txt `
-    root_dir = sys.argv[1]
+    parser.add_argument("hashes_file", nargs="?", help="hashes file path (optional)")
+    parser.add_argument("sizes_file", nargs="?", help="sizes file path (optional)")
+    parser.add_argument(
+        "-i",
+        "--identical-trees",
+        help="also report directory trees that are exact copies of each other",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--ignore-names",
+        help="with --identical-trees, match trees by content and shape only",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--similar-dirs",
+        help="also report directory pairs whose contents overlap at least this "
+        "much (estimated Jaccard similarity, 0-1)",
+        type=float,
+        metavar="THRESHOLD",
+    )
+    parser.add_argument(
+        "-n",
+        "--top",
+        help="only report the N largest duplicate groups and directories",
+        type=int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--min-size",
+        help="skip duplicate groups and directories smaller than this many bytes",
+        type=int,
+        default=0,
+        metavar="BYTES",
+    )
+    parser.add_argument(
+        "--out-of-core",
+        help="analyse the hashes and sizes files with external sorts instead of "
+        "building the tree in memory, for inventories larger than RAM",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        help="with --out-of-core, roughly how much memory sorting may use "
+        "(e.g. 512M, 8G; default 1G)",
+        type=parse_size,
+        default=DEFAULT_MEMORY_BUDGET,
+        metavar="BYTES",
+    )
+    parser.add_argument(
+        "--tmp-dir", help="with --out-of-core, directory for temporary files"
+    )
+    parser.add_argument(
+        "--estimate",
+        help="walk root_dir and estimate duplicate files and bytes by hashing "
+        "only a random sample of the size groups",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sample-rate",
+        help="with --estimate, fraction of size groups to hash (default: 0.05)",
+        type=float,
+        default=0.05,
+        metavar="RATE",
+    )
+    parser.add_argument(
+        "--seed", help="with --estimate, random seed for the sample", type=int
+    )
+    parser.add_argument(
+        "--engine",
+        help="how duplicate groups are found: python dicts (default) or "
+        "vectorized numpy sorts",
+        choices=("python", "numpy"),
+        default="python",
+    )
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+
+    if args.engine == "numpy":
+        try:
+            import numpy
+        except ImportError:
+            parser.error("--engine numpy needs NumPy installed (pip install numpy)")
 
-    hashes_file = sizes_file = None
-    if len(sys.argv) >= 3:
-        hashes_file = sys.argv[2]
-    if len(sys.argv) >= 4:
-        sizes_file = sys.argv[3]
+    if args.estimate:
+        if args.hashes_file or args.sizes_file or args.out_of_core:
+            parser.error("--estimate walks root_dir and takes no inventory")
+        if not 0 < args.sample_rate <= 1:
+            parser.error("--sample-rate must be in (0, 1]")
+        estimate_dupes(
+            args.root_dir, args.sample_rate, args.seed, profiler_from_args(args)
+        )
+        sys.exit(0)
+
+    if args.out_of_core:
+        if not (args.hashes_file and args.sizes_file):
+            parser.error("--out-of-core needs both a hashes file and a sizes file")
+        if args.identical_trees or args.similar_dirs is not None:
+            parser.error("--identical-trees and --similar-dirs need the in-memory tree")
+        file_dupes_out_of_core(
+            args.root_dir,
+            args.hashes_file,
+            args.sizes_file,
+            max_lines_for(args.memory_budget),
+            args.tmp_dir,
+            profiler_from_args(args),
+            args.top,
+            args.min_size,
+        )
+        sys.exit(0)
 
-    file_dupes(root_dir, hashes_file, sizes_file)
+    file_dupes(
+        args.root_dir,
+        args.hashes_file,
+        args.sizes_file,
+        profiler_from_args(args),
+        args.identical_trees,
+        args.ignore_names,
+        args.similar_dirs,
+        args.top,
+        args.min_size,
+        args.engine,
+    )
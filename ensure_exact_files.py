@@ -3,10 +3,12 @@ import base64
 from os import path
 from typing import Dict
 
+from inventory_io import open_inventory
+
 
 def get_common_path(hashes_file: str) -> bytes:
     paths = []
-    with open(hashes_file, "r", encoding="utf-8") as hashes_file_handle:
+    with open_inventory(hashes_file, "r") as hashes_file_handle:
         line_no = 0
         while True:
             line = hashes_file_handle.readline()
@@ -79,7 +81,7 @@ if __name__ == "__main__":
 
     reference_files = dict()  # type: Dict[bytes, str]
     print("Reading reference file...")
-    with open(args.reference_hashes_file, "r", encoding="utf-8") as hashes_file_handle:
+    with open_inventory(args.reference_hashes_file, "r") as hashes_file_handle:
         line_no = 0
         while True:
             line = hashes_file_handle.readline()
@@ -108,7 +110,7 @@ if __name__ == "__main__":
     )
 
     print("Reading test file...")
-    with open(args.test_hashes_file, "r", encoding="utf-8") as hashes_file_handle:
+    with open_inventory(args.test_hashes_file, "r") as hashes_file_handle:
         line_no = 0
         while True:
             line = hashes_file_handle.readline()
@@ -0,0 +1,53 @@
+import heapq
+import os
+import shutil
+import tempfile
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Text, TextIO
+
+
+DEFAULT_MAX_LINES = 1000000
+
+
+def external_sort(
+    lines: Iterable[Text],
+    key: Callable[[Text], Any],
+    max_lines: int = DEFAULT_MAX_LINES,
+    tmp_dir: Optional[Text] = None,
+) -> Iterator[Text]:
+    """Sort newline-terminated lines by key using bounded memory.
+
+    Lines are sorted in runs of at most max_lines, each run is spilled to a
+    temporary file, and the runs are lazily merged. Inputs that fit in one
+    run never touch the disk. The sort is stable.
+    """
+    run_dir = None  # type: Optional[Text]
+    run_files = []  # type: List[TextIO]
+    try:
+        run = []  # type: List[Text]
+        for line in lines:
+            run.append(line)
+            if len(run) >= max_lines:
+                if run_dir is None:
+                    run_dir = tempfile.mkdtemp(prefix="dupe-finder-sort-", dir=tmp_dir)
+                run_files.append(_spill(sorted(run, key=key), run_dir, len(run_files)))
+                run = []
+        run.sort(key=key)
+
+        if not run_files:
+            yield from run
+            return
+
+        # Earlier runs hold earlier lines, so merging in run order stays stable
+        yield from heapq.merge(*run_files, iter(run), key=key)
+    finally:
+        for run_file in run_files:
+            run_file.close()
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def _spill(run: List[Text], run_dir: Text, index: int) -> TextIO:
+    filename = os.path.join(run_dir, "run-{:06d}.txt".format(index))
+    with open(filename, "w", encoding="utf-8", errors="surrogateescape") as f:
+        f.writelines(run)
+    return open(filename, "r", encoding="utf-8", errors="surrogateescape")
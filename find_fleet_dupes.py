@@ -0,0 +1,273 @@
+import argparse
+import base64
+import heapq
+from multiprocessing import Pool
+import os
+import shutil
+import sys
+import tempfile
+from typing import Dict, Iterator, List, Text, Tuple
+
+from compact_inventory import latest_records
+from external_sort import DEFAULT_MAX_LINES
+from profiling import add_profiling_arguments, profiler_from_args
+
+
+def shard_of(hex_digest: Text, shard_count: int) -> int:
+    return int(hex_digest[:8], 16) % shard_count
+
+
+def shard_path(shard_dir: Text, shard: int, inventory_index: int) -> Text:
+    return os.path.join(
+        shard_dir, "shard-{:04d}".format(shard), "{:04d}.txt".format(inventory_index)
+    )
+
+
+def partition_inventory(
+    task: Tuple[int, Text, Text, Text, Text, int, int],
+) -> Tuple[Text, int, int]:
+    """Map step: split one host's inventory into shard files by digest prefix.
+
+    Inventories are appended to, so only the latest hash and size of each
+    path count. Both files are reduced to those with external sorts by path
+    and joined as they stream past, so memory stays bounded by max_lines.
+    Each output record is "<digest>  <size>  <label>  <b64 path>". Every
+    inventory gets its own file per shard so workers never share a file.
+    Returns (label, records written, problem lines).
+    """
+    (
+        inventory_index,
+        label,
+        hashes_file,
+        sizes_file,
+        shard_dir,
+        shard_count,
+        max_lines,
+    ) = task
+
+    stats = {"read": 0, "problems": 0}
+    sizes = latest_records(sizes_file, False, max_lines, shard_dir, stats)
+    size_record = next(sizes, None)
+    outputs = [
+        open(shard_path(shard_dir, shard, inventory_index), "w", encoding="utf-8")
+        for shard in range(shard_count)
+    ]
+    written = missing_sizes = 0
+    try:
+        for path_bytes, hex_digest, b64path in latest_records(
+            hashes_file, True, max_lines, shard_dir, stats
+        ):
+            while size_record is not None and size_record[0] < path_bytes:
+                size_record = next(sizes, None)
+            if size_record is None or size_record[0] != path_bytes:
+                missing_sizes += 1
+                continue
+
+            outputs[shard_of(hex_digest, shard_count)].write(
+                "{}  {}  {}  {}\n".format(hex_digest, size_record[1], label, b64path)
+            )
+            written += 1
+    finally:
+        for output in outputs:
+            output.close()
+
+    return label, written, stats["problems"] + missing_sizes
+
+
+def group_shard(task: Tuple[Text, int, int, bool]) -> Tuple[Text, int]:
+    """Reduce step: group one shard's records by digest and size.
+
+    Groups are written to <shard>/groups.txt as
+    "<size>  <digest>  <label>:<b64 path>,..." ordered by size descending, so
+    the shards can be merged into one sorted report without loading them.
+    Returns (groups file, number of groups).
+    """
+    shard_dir, shard, inventory_count, cross_host_only = task
+    directory = os.path.join(shard_dir, "shard-{:04d}".format(shard))
+
+    records = dict()  # type: Dict[Tuple[int, Text], List[Text]]
+    for inventory_index in range(inventory_count):
+        with open(
+            shard_path(shard_dir, shard, inventory_index), "r", encoding="utf-8"
+        ) as shard_file_handle:
+            for line in shard_file_handle:
+                hex_digest, size_text, label, b64path = line.rstrip("\n").split("  ")
+                key = (int(size_text), hex_digest)
+                copies = records.get(key)
+                if copies is None:
+                    records[key] = [label + ":" + b64path]
+                else:
+                    copies.append(label + ":" + b64path)
+
+    groups = [
+        (size, hex_digest, copies)
+        for (size, hex_digest), copies in records.items()
+        if len(copies) > 1
+        and (not cross_host_only or len({c.partition(":")[0] for c in copies}) > 1)
+    ]
+    records.clear()
+    groups.sort(reverse=True)
+
+    groups_file = os.path.join(directory, "groups.txt")
+    with open(groups_file, "w", encoding="utf-8") as groups_file_handle:
+        for size, hex_digest, copies in groups:
+            groups_file_handle.write(
+                "{}  {}  {}\n".format(size, hex_digest, ",".join(copies))
+            )
+    return groups_file, len(groups)
+
+
+def read_groups(groups_file: Text) -> Iterator[Tuple[int, Text, Text]]:
+    with open(groups_file, "r", encoding="utf-8") as groups_file_handle:
+        for line in groups_file_handle:
+            size, hex_digest, copies = line.rstrip("\n").split("  ")
+            yield int(size), hex_digest, copies
+
+
+def decode_copy(copy: Text) -> Text:
+    label, _, b64path = copy.partition(":")
+    path_bytes = base64.b64decode(b64path)
+    return "{}:{}".format(label, path_bytes.decode("utf-8", errors="replace"))
+
+
+def parse_inventory_argument(value: Text) -> Tuple[Text, Text, Text]:
+    label, _, files = value.partition("=")
+    hashes_file, _, sizes_file = files.partition(",")
+    if not (label and hashes_file and sizes_file):
+        raise argparse.ArgumentTypeError(
+            "expected LABEL=HASHES_FILE,SIZES_FILE but got " + value
+        )
+    return label, hashes_file, sizes_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find duplicates across many hosts' hashes/sizes inventories "
+        "by partitioning records into digest shards and grouping shards in "
+        "parallel"
+    )
+    parser.add_argument(
+        "inventories",
+        nargs="+",
+        type=parse_inventory_argument,
+        metavar="LABEL=HASHES_FILE,SIZES_FILE",
+        help="inventory produced by find_hashes_and_sizes.py, tagged with a host label",
+    )
+    parser.add_argument(
+        "-n", "--shards", type=int, default=64, help="number of digest shards"
+    )
+    parser.add_argument(
+        "-j",
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="worker processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "-m",
+        "--max-lines",
+        type=int,
+        default=DEFAULT_MAX_LINES,
+        help="lines sorted in memory per worker while partitioning",
+    )
+    parser.add_argument(
+        "--shard-dir", help="directory for shard files (default: a temporary one)"
+    )
+    parser.add_argument(
+        "--keep-shards", help="don't delete the shard files", action="store_true"
+    )
+    parser.add_argument(
+        "-x",
+        "--cross-host-only",
+        help="only report groups whose copies span more than one label",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--top", type=int, metavar="N", help="only report the N largest groups"
+    )
+    parser.add_argument(
+        "--min-size", type=int, default=0, metavar="BYTES", help="skip smaller files"
+    )
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+
+    labels = [label for label, _, _ in args.inventories]
+    assert len(set(labels)) == len(labels), "Inventory labels must be unique"
+    for label in labels:
+        assert ":" not in label and " " not in label, "Bad label " + label
+    assert args.shards > 0, "Need at least one shard"
+
+    profiler = profiler_from_args(args)
+    shard_dir = args.shard_dir or tempfile.mkdtemp(prefix="dupe-finder-shards-")
+    try:
+        for shard in range(args.shards):
+            os.makedirs(
+                os.path.join(shard_dir, "shard-{:04d}".format(shard)), exist_ok=True
+            )
+
+        with Pool(args.processes) as pool:
+            with profiler.phase("partition"):
+                print("Partitioning {} inventories...".format(len(args.inventories)))
+                tasks = [
+                    (
+                        index,
+                        label,
+                        hashes_file,
+                        sizes_file,
+                        shard_dir,
+                        args.shards,
+                        args.max_lines,
+                    )
+                    for index, (label, hashes_file, sizes_file) in enumerate(
+                        args.inventories
+                    )
+                ]
+                for label, written, problems in pool.imap_unordered(
+                    partition_inventory, tasks
+                ):
+                    print(
+                        "{}: {} records ({} skipped)".format(label, written, problems)
+                    )
+
+            with profiler.phase("group shards"):
+                print("Grouping {} shards...".format(args.shards))
+                groups_files = []  # type: List[Text]
+                total_groups = 0
+                for groups_file, group_count in pool.imap_unordered(
+                    group_shard,
+                    [
+                        (shard_dir, shard, len(args.inventories), args.cross_host_only)
+                        for shard in range(args.shards)
+                    ],
+                ):
+                    groups_files.append(groups_file)
+                    total_groups += group_count
+                print("Found {} duplicate groups".format(total_groups))
+
+        with profiler.phase("merge"):
+            print("------ FILES ------")
+            merged = heapq.merge(
+                *[read_groups(f) for f in groups_files],
+                key=lambda group: group[0],
+                reverse=True,
+            )
+            reported = 0
+            for size, hex_digest, copies in merged:
+                if size < args.min_size or (args.top and reported >= args.top):
+                    break
+                copy_list = copies.split(",")
+                hosts = len({c.partition(":")[0] for c in copy_list})
+                sys.stdout.write(
+                    "{} bytes ({}) on {} hosts: \n".format(size, hex_digest, hosts)
+                )
+                for index, copy in enumerate(copy_list):
+                    if index:
+                        sys.stdout.write(", ")
+                    sys.stdout.write(decode_copy(copy))
+                sys.stdout.write("\n\n")
+                reported += 1
+    finally:
+        if not (args.keep_shards or args.shard_dir):
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    profiler.print_summary()
@@ -1,9 +1,17 @@
 import argparse
 import base64
+from contextlib import closing
 import hashlib
+import math
 import os
 import stat
 from time import time
+from typing import IO, Dict
+
+from inventory_io import COMPRESSIONS, open_inventory
+from profiling import NULL_PROFILER, add_profiling_arguments, profiler_from_args
+from read_engine import ReadEngine
+from scan_scheduler import SCHEDULE_ORDERS, ScanScheduler, Throttle
 
 
 CHUNK_SIZE = 1024 * 1024 * 32  # 32MB
@@ -19,180 +27,148 @@ def convert_size(size_bytes):
     return "%s %s" % (s, size_name[i])
 
 
+class ScanStopped(KeyboardInterrupt):
+    """Raised inside a scan when its stop event is set; handled like Ctrl-C."""
+
+
 class DiskReader:
     def __init__(
-        self, directory, hashes_file, sizes_file, rewrite, trust_all_hashes
+        self,
+        directory,
+        hashes_file,
+        sizes_file,
+        rewrite,
+        trust_all_hashes,
+        profiler=NULL_PROFILER,
+        recursive=True,
+        read_engine=None,
+        scheduler=None,
+        compression=None,
+        stop=None,
     ) -> None:
         self.directory = directory
         self.hashes_file = hashes_file
         self.sizes_file = sizes_file
         self.rewrite = rewrite
         self.trust_all_hashes = trust_all_hashes
-
-    def run(self):
+        self.profiler = profiler
+        self.recursive = recursive
+        self.read_engine = read_engine or ReadEngine(CHUNK_SIZE)
+        self.scheduler = scheduler
+        self.compression = compression
+        # A threading.Event another thread can set to stop the scan early
+        self.stop = stop
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
         self.files_count = 0
         self.symlinks_count = 0
         self.others_count = 0
         self.total_size = 0
         self.errors_count = 0
 
+    def run(self) -> bool:
+        """Scan the directory; returns False if interrupted before finishing."""
+        self.reset_counters()
+
         print("Producing:")
         if self.rewrite:
-            print(hashes_file + " (rewriting)")
+            print(self.hashes_file + " (rewriting)")
         else:
-            print(hashes_file)
+            print(self.hashes_file)
         if self.trust_all_hashes:
-            print(sizes_file + " (ignoring)")
+            print(self.sizes_file + " (ignoring)")
         elif self.rewrite:
-            print(sizes_file + " (rewriting)")
+            print(self.sizes_file + " (rewriting)")
         else:
-            print(sizes_file)
+            print(self.sizes_file)
 
         spaces = "".join([" " for _ in range(48)])
 
-        known_hashes_dict = dict()
-        if os.path.exists(hashes_file):
-            print("Reading existing hashes file...")
-            with open(hashes_file, "r", encoding="utf-8") as hashes_file_handle:
-                while True:
-                    line = hashes_file_handle.readline()
-                    if not line:
-                        break
-
-                    parts = line.split("  ")
-                    if len(parts) >= 3 and len(parts[0]) == 32:
-                        b64path = parts[2].strip()
-                        known_hashes_dict[b64path] = parts[0].strip()
-
-        known_sizes_dict = dict()
-        if os.path.exists(sizes_file) and not self.trust_all_hashes:
-            print("Reading existing sizes file...")
-            with open(sizes_file, "r", encoding="utf-8") as sizes_file_handle:
-                while True:
-                    line = sizes_file_handle.readline()
-                    if not line:
-                        break
-
-                    parts = line.split("  ")
-                    if len(parts) >= 3:
-                        try:
+        with self.profiler.phase("load inventory"):
+            known_hashes_dict = dict()
+            if os.path.exists(self.hashes_file):
+                print("Reading existing hashes file...")
+                with open_inventory(self.hashes_file, "r") as hashes_file_handle:
+                    while True:
+                        line = hashes_file_handle.readline()
+                        if not line:
+                            break
+
+                        parts = line.split("  ")
+                        if len(parts) >= 3 and len(parts[0]) == 32:
                             b64path = parts[2].strip()
-                            known_sizes_dict[b64path] = int(parts[0].strip())
-                        except:
-                            pass
+                            known_hashes_dict[b64path] = parts[0].strip()
+
+            known_sizes_dict = dict()
+            if os.path.exists(self.sizes_file) and not self.trust_all_hashes:
+                print("Reading existing sizes file...")
+                with open_inventory(self.sizes_file, "r") as sizes_file_handle:
+                    while True:
+                        line = sizes_file_handle.readline()
+                        if not line:
+                            break
+
+                        parts = line.split("  ")
+                        if len(parts) >= 3:
+                            try:
+                                b64path = parts[2].strip()
+                                known_sizes_dict[b64path] = int(parts[0].strip())
+                            except:
+                                pass
 
         hashes_file_mode = "a" if len(known_hashes_dict) and not self.rewrite else "w"
         sizes_file_mode = "a" if len(known_sizes_dict) and not self.rewrite else "w"
 
         last_output = 0
-        with open(
-            hashes_file, hashes_file_mode, encoding="utf-8"
-        ) as hashes_file_handle, open(
-            sizes_file, sizes_file_mode, encoding="utf-8"
+        completed = True
+        # Appending keeps whatever compression the files already have
+        with open_inventory(
+            self.hashes_file, hashes_file_mode, compression=self.compression
+        ) as hashes_file_handle, open_inventory(
+            self.sizes_file, sizes_file_mode, compression=self.compression
         ) as sizes_file_handle:
             try:
                 print("Walking filesystem...")
                 for root_bytes, dirs_bytes, files_bytes in os.walk(
-                    str(self.directory).encode("utf-8"), onerror=self.on_error
+                    os.fsencode(self.directory), onerror=self.on_error
                 ):
+                    if not self.recursive:
+                        # Only the files directly inside self.directory
+                        dirs_bytes.clear()
                     for name_bytes in files_bytes:
+                        self.check_stop()
                         path_bytes = os.path.join(root_bytes, name_bytes)
                         if os.path.islink(path_bytes):
                             self.symlinks_count += 1
                             continue
 
-                        st_mode = os.stat(path_bytes).st_mode
+                        with self.profiler.phase("stat"):
+                            st = os.stat(path_bytes)
                         if (
-                            stat.S_ISBLK(st_mode)
-                            or stat.S_ISCHR(st_mode)
-                            or stat.S_ISFIFO(st_mode)
-                            or stat.S_ISSOCK(st_mode)
+                            stat.S_ISBLK(st.st_mode)
+                            or stat.S_ISCHR(st.st_mode)
+                            or stat.S_ISFIFO(st.st_mode)
+                            or stat.S_ISSOCK(st.st_mode)
                         ):
                             self.others_count += 1
                             continue
 
-                        self.files_count += 1
-                        fixed_path = path_bytes.decode("utf-8", errors="replace")
-                        b64path = base64.b64encode(path_bytes).decode("utf-8").strip()
-
-                        try:
-                            path_bytes.decode("utf-8", errors="strict")
-                            is_utf8 = "utf-8"
-                        except:
-                            is_utf8 = "unknown-encoding"
-
-                        try:
-                            size = os.path.getsize(path_bytes)
-                            write_to_sizes_file = self.rewrite
-                            hash_needs_refresh = not self.trust_all_hashes
-                            if b64path in known_sizes_dict:
-                                if known_sizes_dict[b64path] == size:
-                                    hash_needs_refresh = False
-                                else:
-                                    write_to_sizes_file = True
-                                del known_sizes_dict[b64path]
-                            else:
-                                write_to_sizes_file = True
-
-                            self.total_size += size
-                            if write_to_sizes_file:
-                                sizes_file_handle.write(
-                                    "{}  {}  {}\n".format(size, is_utf8, b64path)
-                                )
-
-                            write_to_hashes_file = self.rewrite
-                            if b64path in known_hashes_dict and not hash_needs_refresh:
-                                hash = known_hashes_dict[b64path]
-                                del known_hashes_dict[b64path]
-                            else:
-                                write_to_hashes_file = True
-                                with open(path_bytes, "rb") as f:
-                                    size_read = 0
-                                    hasher = hashlib.md5()
-                                    while True:
-                                        try:
-                                            buf = f.read(CHUNK_SIZE)
-                                        except KeyboardInterrupt:
-                                            print("Stopped on " + fixed_path)
-                                            raise
-
-                                        size_read += len(buf)
-                                        if not buf:
-                                            break
-                                        if size_read < size:
-                                            display_filename = fixed_path
-                                            if len(display_filename) > 30:
-                                                display_filename = (
-                                                    "..."
-                                                    + fixed_path[len(fixed_path) - 27 :]
-                                                )
-
-                                            progress = "Reading {} ({}%). Completed {} in {} files...\r".format(
-                                                display_filename,
-                                                int(100 * size_read / size),
-                                                convert_size(self.total_size),
-                                                self.files_count,
-                                            )
-                                            print(progress, end="")
-
-                                        hasher.update(buf)
-
-                                    hash = hasher.hexdigest()
-
-                            if write_to_hashes_file:
-                                hashes_file_handle.write(
-                                    "{}  {}  {}\n".format(hash, is_utf8, b64path)
-                                )
-
-                        except Exception as error:
-                            if isinstance(error, KeyboardInterrupt):
-                                raise
-
-                            self.errors_count += 1
-                            try:
-                                print(error.message)
-                            except:
-                                print(error)
+                        if self.scheduler:
+                            self.scheduler.add(path_bytes, st)
+                            if not self.scheduler.is_full():
+                                continue
+                            batch = self.scheduler.drain()
+                        else:
+                            batch = [path_bytes]
+                        for scheduled_path in batch:
+                            self.process_file(
+                                scheduled_path,
+                                known_hashes_dict,
+                                known_sizes_dict,
+                                hashes_file_handle,
+                                sizes_file_handle,
+                            )
 
                     now = int(time())
                     if now != last_output:
@@ -206,7 +182,18 @@ class DiskReader:
                         print(progress, end="")
                         last_output = now
 
+                if self.scheduler:
+                    for scheduled_path in self.scheduler.drain():
+                        self.process_file(
+                            scheduled_path,
+                            known_hashes_dict,
+                            known_sizes_dict,
+                            hashes_file_handle,
+                            sizes_file_handle,
+                        )
+
             except KeyboardInterrupt:
+                completed = False
                 print()
                 print("Interrupted")
                 if self.rewrite and (len(known_hashes_dict) or len(known_sizes_dict)):
@@ -225,6 +212,104 @@ class DiskReader:
         print("Skipped symlinks: {}".format(self.symlinks_count))
         print("Skipped block devices, FIFOs, etc: {}".format(self.others_count))
         print("Errors: {}".format(self.errors_count))
+        if self.read_engine.hole_bytes_skipped:
+            print(
+                "Skipped reading {} of sparse file holes".format(
+                    convert_size(self.read_engine.hole_bytes_skipped)
+                )
+            )
+        self.profiler.print_summary()
+        return completed
+
+    def check_stop(self) -> None:
+        if self.stop is not None and self.stop.is_set():
+            raise ScanStopped()
+
+    def process_file(
+        self,
+        path_bytes: bytes,
+        known_hashes_dict: Dict[str, str],
+        known_sizes_dict: Dict[str, int],
+        hashes_file_handle: IO[str],
+        sizes_file_handle: IO[str],
+    ) -> None:
+        self.files_count += 1
+        fixed_path = path_bytes.decode("utf-8", errors="replace")
+        b64path = base64.b64encode(path_bytes).decode("utf-8").strip()
+
+        try:
+            path_bytes.decode("utf-8", errors="strict")
+            is_utf8 = "utf-8"
+        except:
+            is_utf8 = "unknown-encoding"
+
+        try:
+            size = os.path.getsize(path_bytes)
+            write_to_sizes_file = self.rewrite
+            hash_needs_refresh = not self.trust_all_hashes
+            if b64path in known_sizes_dict:
+                if known_sizes_dict[b64path] == size:
+                    hash_needs_refresh = False
+                else:
+                    write_to_sizes_file = True
+                del known_sizes_dict[b64path]
+            else:
+                write_to_sizes_file = True
+
+            self.total_size += size
+            if write_to_sizes_file:
+                sizes_file_handle.write("{}  {}  {}\n".format(size, is_utf8, b64path))
+
+            write_to_hashes_file = self.rewrite
+            if b64path in known_hashes_dict and not hash_needs_refresh:
+                hash = known_hashes_dict[b64path]
+                del known_hashes_dict[b64path]
+            else:
+                write_to_hashes_file = True
+                with self.profiler.phase("hash"), closing(
+                    self.read_engine.chunks(path_bytes)
+                ) as chunks:
+                    size_read = 0
+                    hasher = hashlib.md5()
+                    while True:
+                        try:
+                            self.check_stop()
+                            buf = next(chunks, b"")
+                        except KeyboardInterrupt:
+                            print("Stopped on " + fixed_path)
+                            raise
+
+                        size_read += len(buf)
+                        if not buf:
+                            break
+                        if size_read < size:
+                            display_filename = fixed_path
+                            if len(display_filename) > 30:
+                                display_filename = (
+                                    "..." + fixed_path[len(fixed_path) - 27 :]
+                                )
+
+                            progress = "Reading {} ({}%). Completed {} in {} files...\r".format(
+                                display_filename,
+                                int(100 * size_read / size),
+                                convert_size(self.total_size),
+                                self.files_count,
+                            )
+                            print(progress, end="")
+
+                        hasher.update(buf)
+
+                    hash = hasher.hexdigest()
+
+            if write_to_hashes_file:
+                hashes_file_handle.write("{}  {}  {}\n".format(hash, is_utf8, b64path))
+
+        except Exception as error:
+            if isinstance(error, KeyboardInterrupt):
+                raise
+
+            self.errors_count += 1
+            print(error)
 
     def on_error(self, error):
         self.errors_count += 1
@@ -253,6 +338,46 @@ if __name__ == "__main__":
         help="skip checking file sizes and trust all known hashes",
         action="store_true",
     )
+    parser.add_argument(
+        "--drop-cache",
+        help="use posix_fadvise so hashed files don't evict the page cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--skip-holes",
+        help="don't read the holes of sparse files (they hash as zeros)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--schedule",
+        help="read files in walk order (default), or sort batches by inode "
+        "number or by physical extent (FIEMAP) to cut seeks on spinning disks",
+        choices=SCHEDULE_ORDERS,
+        default="walk",
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="files collected per scheduled batch (default: 10000)",
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        "--max-bytes-per-sec",
+        help="throttle reads to this many bytes per second",
+        type=float,
+    )
+    parser.add_argument(
+        "--max-iops",
+        help="throttle opens and reads to this many operations per second",
+        type=float,
+    )
+    parser.add_argument(
+        "--compress",
+        help="write new inventory files compressed in independent blocks, "
+        "which readers decompress in parallel",
+        choices=COMPRESSIONS,
+    )
+    add_profiling_arguments(parser)
     args = parser.parse_args()
 
     dirname = os.path.basename(args.directory)
@@ -269,7 +394,22 @@ if __name__ == "__main__":
     hashes_file = os.path.abspath(hashes_file)
     sizes_file = os.path.abspath(sizes_file)
 
+    throttle = None
+    if args.max_bytes_per_sec or args.max_iops:
+        throttle = Throttle(args.max_bytes_per_sec, args.max_iops)
+    scheduler = None
+    if args.schedule != "walk":
+        scheduler = ScanScheduler(args.schedule, args.batch_size)
+
     reader = DiskReader(
-        args.directory, hashes_file, sizes_file, args.rewrite, args.trust_all_hashes
+        args.directory,
+        hashes_file,
+        sizes_file,
+        args.rewrite,
+        args.trust_all_hashes,
+        profiler_from_args(args),
+        read_engine=ReadEngine(CHUNK_SIZE, args.drop_cache, args.skip_holes, throttle),
+        scheduler=scheduler,
+        compression=args.compress,
     )
     reader.run()
@@ -2,6 +2,8 @@ import argparse
 import base64
 from typing import Set
 
+from inventory_io import open_inventory
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -53,9 +55,7 @@ if __name__ == "__main__":
     reference_hashes = set()  # type: Set[str]
     if not args.v1:
         print("Reading reference file...")
-        with open(
-            args.reference_hashes_file, "r", encoding="utf-8"
-        ) as hashes_file_handle:
+        with open_inventory(args.reference_hashes_file, "r") as hashes_file_handle:
             line_no = 0
             while True:
                 line = hashes_file_handle.readline()
@@ -83,7 +83,7 @@ if __name__ == "__main__":
         try:
             print("Reading reference file (v1 format)...")
 
-            with open(args.reference_hashes_file, "rb") as hashes_file_handle:
+            with open_inventory(args.reference_hashes_file, "rb") as hashes_file_handle:
                 line_no = 0
                 line = ""
                 while True:
@@ -140,7 +140,7 @@ if __name__ == "__main__":
     )
 
     print("Reading test file...")
-    with open(args.test_hashes_file, "r", encoding="utf-8") as hashes_file_handle:
+    with open_inventory(args.test_hashes_file, "r") as hashes_file_handle:
         line_no = 0
         while True:
             line = hashes_file_handle.readline()
@@ -178,8 +178,8 @@ if __name__ == "__main__":
 
             if not args.v1:
                 print("Re-reading reference file...")
-                with open(
-                    args.reference_hashes_file, "r", encoding="utf-8"
+                with open_inventory(
+                    args.reference_hashes_file, "r"
                 ) as hashes_file_handle:
                     while True:
                         line = hashes_file_handle.readline()
@@ -203,7 +203,9 @@ if __name__ == "__main__":
 
             else:
                 print("Re-reading reference file (v1 format)...")
-                with open(args.reference_hashes_file, "rb") as hashes_file_handle:
+                with open_inventory(
+                    args.reference_hashes_file, "rb"
+                ) as hashes_file_handle:
                     line_no = 0
                     line = ""
                     while True:
@@ -0,0 +1,367 @@
+import argparse
+import base64
+import binascii
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Text, Tuple
+
+from inventory_io import detect_compression, open_inventory
+
+
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or "/tmp",
+    "dupe-finder-{}.sock".format(os.getuid()),
+)
+
+
+class Inventory:
+    """In-memory index of one hashes file: digest -> paths and path -> digest.
+
+    Digests are kept as 16 raw bytes and paths as raw bytes. The file is
+    followed by offset and inode: appended records (as written by
+    find_hashes_and_sizes.py or watch_inventory.py) are read incrementally,
+    and a replaced or truncated file (e.g. after compaction) is reloaded.
+    Compressed files can't be resumed at an offset, so they are reloaded
+    whenever they change. Later records for a path supersede earlier ones.
+    """
+
+    def __init__(self, name: Text, hashes_file: Text) -> None:
+        self.name = name
+        self.hashes_file = hashes_file
+        # Paths are dict keys (values unused) for O(1) removal in file order
+        self.paths_by_digest = dict()  # type: Dict[bytes, Dict[bytes, None]]
+        self.digest_by_path = dict()  # type: Dict[bytes, bytes]
+        self.identity = None  # type: Optional[Tuple[int, int]]
+        self.offset = 0
+        self.records = 0
+        self.problems = 0
+
+    def clear(self) -> None:
+        self.paths_by_digest = dict()
+        self.digest_by_path = dict()
+        self.offset = 0
+        self.records = 0
+        self.problems = 0
+
+    def refresh(self) -> bool:
+        """Bring the index up to date with the file; True if anything changed."""
+        st = os.stat(self.hashes_file)
+        identity = (st.st_dev, st.st_ino)
+        if identity != self.identity or st.st_size < self.offset:
+            self.clear()
+            self.identity = identity
+        elif st.st_size == self.offset:
+            return False
+
+        if detect_compression(self.hashes_file):
+            self.clear()
+            with open_inventory(self.hashes_file, "rb") as hashes_file_handle:
+                for line in hashes_file_handle:
+                    if line.endswith(b"\n"):
+                        self.add_line(line)
+            self.offset = st.st_size
+            return True
+
+        with open(self.hashes_file, "rb") as hashes_file_handle:
+            hashes_file_handle.seek(self.offset)
+            while True:
+                line = hashes_file_handle.readline()
+                if not line.endswith(b"\n"):
+                    # Not written completely yet; pick it up next time
+                    break
+                self.offset += len(line)
+                self.add_line(line)
+        return True
+
+    def add_line(self, line: bytes) -> None:
+        parts = line.split(b"  ")
+        try:
+            assert len(parts) >= 3 and len(parts[0]) == 32
+            digest = binascii.unhexlify(parts[0])
+            path_bytes = base64.b64decode(parts[2].strip(), validate=True)
+        except (AssertionError, ValueError):
+            self.problems += 1
+            return
+
+        self.records += 1
+        old_digest = self.digest_by_path.get(path_bytes)
+        if old_digest == digest:
+            return
+        if old_digest is not None:
+            old_paths = self.paths_by_digest[old_digest]
+            del old_paths[path_bytes]
+            if not old_paths:
+                del self.paths_by_digest[old_digest]
+        self.digest_by_path[path_bytes] = digest
+        self.paths_by_digest.setdefault(digest, dict())[path_bytes] = None
+
+    def status(self) -> Dict[Text, Any]:
+        return {
+            "name": self.name,
+            "hashes_file": self.hashes_file,
+            "files": len(self.digest_by_path),
+            "digests": len(self.paths_by_digest),
+            "records": self.records,
+            "problems": self.problems,
+            "offset": self.offset,
+        }
+
+
+def _b64(path_bytes: bytes) -> Text:
+    return base64.b64encode(path_bytes).decode("ascii")
+
+
+class InventoryIndex:
+    """The inventories served by the daemon, refreshed before each query."""
+
+    def __init__(self, inventories: List[Inventory]) -> None:
+        self.inventories = {inventory.name: inventory for inventory in inventories}
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        for inventory in self.inventories.values():
+            print("Loading {}...".format(inventory.hashes_file))
+            inventory.refresh()
+            print(
+                "{name}: {files} files, {digests} unique digests, "
+                "{problems} bad lines".format(**inventory.status())
+            )
+
+    def inventory(self, name: Text) -> Inventory:
+        inventory = self.inventories.get(name)
+        if inventory is None:
+            raise KeyError("Unknown inventory " + name)
+        inventory.refresh()
+        return inventory
+
+    def handle(self, request: Any) -> Dict[Text, Any]:
+        if not isinstance(request, dict):
+            raise TypeError("Expected a JSON object but got {}".format(request))
+        with self.lock:
+            op = request.get("op")
+            if op == "paths":
+                inventory = self.inventory(request["inventory"])
+                digest = binascii.unhexlify(request["digest"])
+                paths = inventory.paths_by_digest.get(digest, dict())
+                return {"paths": [_b64(p) for p in paths]}
+            elif op == "has":
+                inventory = self.inventory(request["inventory"])
+                path_bytes = base64.b64decode(request["path"])
+                found = inventory.digest_by_path.get(path_bytes)
+                response = {
+                    "present": found is not None,
+                    "digest": (
+                        binascii.hexlify(found).decode("ascii") if found else None
+                    ),
+                }  # type: Dict[Text, Any]
+                if request.get("digest"):
+                    response["matches"] = found == binascii.unhexlify(request["digest"])
+                return response
+            elif op == "missing":
+                reference = self.inventory(request["inventory"])
+                test = self.inventory(request["against"])
+                limit = request.get("limit")
+                missing_digests = 0
+                missing_paths = []  # type: List[Text]
+                for digest, digest_paths in reference.paths_by_digest.items():
+                    if digest in test.paths_by_digest:
+                        continue
+                    missing_digests += 1
+                    for path_bytes in digest_paths:
+                        if limit is None or len(missing_paths) < limit:
+                            missing_paths.append(_b64(path_bytes))
+                return {"missing_digests": missing_digests, "paths": missing_paths}
+            elif op == "status":
+                for inventory in self.inventories.values():
+                    inventory.refresh()
+                return {
+                    "inventories": [
+                        inventory.status() for inventory in self.inventories.values()
+                    ]
+                }
+            raise ValueError("Unknown op {}".format(op))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """One JSON request per line in, one JSON response per line out."""
+
+    server: "InventoryServer"
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                response = self.server.index.handle(json.loads(line))
+                response["ok"] = True
+            except (KeyError, ValueError, TypeError, binascii.Error, OSError) as e:
+                response = {"ok": False, "error": "{}: {}".format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class InventoryServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: Text, index: InventoryIndex) -> None:
+        self.index = index
+        super().__init__(socket_path, RequestHandler)
+
+
+def serve(socket_path: Text, inventories: List[Inventory]) -> None:
+    index = InventoryIndex(inventories)
+    index.load()
+
+    if os.path.exists(socket_path):
+        # Only take over the socket if nothing is listening on it
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            raise Exception("Another daemon is listening on " + socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+
+    old_umask = os.umask(0o077)
+    try:
+        server = InventoryServer(socket_path, index)
+    finally:
+        os.umask(old_umask)
+    # Exit through the finally below on SIGTERM too, removing the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Listening on {}".format(socket_path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def query(socket_path: Text, request: Dict[Text, Any]) -> Dict[Text, Any]:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with client.makefile("rb") as responses:
+            response = json.loads(responses.readline())  # type: Dict[Text, Any]
+    if not response.pop("ok"):
+        raise Exception(response["error"])
+    return response
+
+
+def print_path(b64path: Text) -> None:
+    path_bytes = base64.b64decode(b64path)
+    try:
+        print(path_bytes.decode("utf-8"))
+    except UnicodeDecodeError:
+        print("(approx) " + path_bytes.decode("utf-8", errors="ignore"))
+
+
+def parse_inventory_argument(value: Text) -> Inventory:
+    name, _, hashes_file = value.partition("=")
+    if not (name and hashes_file):
+        raise argparse.ArgumentTypeError("expected NAME=HASHES_FILE but got " + value)
+    return Inventory(name, os.path.abspath(hashes_file))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Keep hashes inventories loaded in a daemon and answer "
+        "queries about them over a Unix socket"
+    )
+    parser.add_argument(
+        "-S",
+        "--socket",
+        default=DEFAULT_SOCKET,
+        help="socket path (default: {})".format(DEFAULT_SOCKET),
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="load inventories and serve")
+    serve_parser.add_argument(
+        "inventories",
+        nargs="+",
+        type=parse_inventory_argument,
+        metavar="NAME=HASHES_FILE",
+        help="hashes file produced by find_hashes_and_sizes.py, under a name",
+    )
+
+    paths_parser = subparsers.add_parser("paths", help="paths with a digest")
+    paths_parser.add_argument("inventory", help="inventory name")
+    paths_parser.add_argument("digest", help="MD5 hex digest")
+
+    has_parser = subparsers.add_parser(
+        "has", help="is a path present (and does it have a digest)"
+    )
+    has_parser.add_argument("inventory", help="inventory name")
+    has_parser.add_argument("path", help="file path as recorded in the inventory")
+    has_parser.add_argument("digest", nargs="?", help="expected MD5 hex digest")
+
+    missing_parser = subparsers.add_parser(
+        "missing", help="files in one inventory whose contents are not in another"
+    )
+    missing_parser.add_argument("reference", help="reference inventory name")
+    missing_parser.add_argument("test", help="test inventory name")
+    missing_parser.add_argument(
+        "-l", "--limit", type=int, help="list at most this many paths"
+    )
+
+    subparsers.add_parser("status", help="show loaded inventories")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        try:
+            serve(args.socket, args.inventories)
+        except KeyboardInterrupt:
+            print()
+            print("Stopped")
+    elif args.command == "paths":
+        response = query(
+            args.socket,
+            {"op": "paths", "inventory": args.inventory, "digest": args.digest},
+        )
+        for b64path in response["paths"]:
+            print_path(b64path)
+        sys.exit(0 if response["paths"] else 1)
+    elif args.command == "has":
+        response = query(
+            args.socket,
+            {
+                "op": "has",
+                "inventory": args.inventory,
+                "path": _b64(os.fsencode(args.path)),
+                "digest": args.digest,
+            },
+        )
+        if not response["present"]:
+            print("Not present")
+            sys.exit(1)
+        print("Present with digest {}".format(response["digest"]))
+        if args.digest and not response["matches"]:
+            print("Digest does not match")
+            sys.exit(1)
+    elif args.command == "missing":
+        response = query(
+            args.socket,
+            {
+                "op": "missing",
+                "inventory": args.reference,
+                "against": args.test,
+                "limit": args.limit,
+            },
+        )
+        if not response["missing_digests"]:
+            print("No files are missing")
+        else:
+            print("{} unique files are missing:".format(response["missing_digests"]))
+            for b64path in response["paths"]:
+                print_path(b64path)
+    else:
+        for status in query(args.socket, {"op": "status"})["inventories"]:
+            print(
+                "{name}: {files} files, {digests} unique digests, {problems} bad "
+                "lines ({hashes_file})".format(**status)
+            )
@@ -0,0 +1,339 @@
+import bz2
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import gzip
+import io
+import itertools
+import lzma
+import multiprocessing
+import os
+import sys
+from typing import IO, Any, Deque, Iterator, List, Optional, Text, Tuple
+
+
+COMPRESSIONS = ("gzip", "xz", "bz2")
+MAGIC_BYTES = ((b"\x1f\x8b", "gzip"), (b"\xfd7zXZ\x00", "xz"), (b"BZh", "bz2"))
+# Uncompressed bytes per independently compressed block
+BLOCK_SIZE = 4 * 1024 * 1024
+INDEX_SUFFIX = ".blocks"
+STREAM_READ_SIZE = 64 * 1024
+MAX_READ_PROCESSES = 8
+
+# (compressed offset, compressed length, uncompressed length)
+Block = Tuple[int, int, int]
+
+
+def detect_compression(filename: Text) -> Optional[Text]:
+    """Compression of a file from its magic bytes, or None for plain text."""
+    try:
+        with open(filename, "rb") as f:
+            head = f.read(6)
+    except FileNotFoundError:
+        return None
+    for magic, compression in MAGIC_BYTES:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def compress(data: bytes, compression: Text) -> bytes:
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    elif compression == "xz":
+        return lzma.compress(data)
+    elif compression == "bz2":
+        return bz2.compress(data)
+    raise ValueError("Unknown compression " + compression)
+
+
+def decompress(data: bytes, compression: Text) -> bytes:
+    if compression == "gzip":
+        return gzip.decompress(data)
+    elif compression == "xz":
+        return lzma.decompress(data)
+    elif compression == "bz2":
+        return bz2.decompress(data)
+    raise ValueError("Unknown compression " + compression)
+
+
+def read_block_index(filename: Text) -> Optional[List[Block]]:
+    """The blocks listed in filename's sidecar index, if it has a usable one
+    (contiguous from the start of the file)."""
+    blocks = []  # type: List[Block]
+    try:
+        with open(filename + INDEX_SUFFIX, "r", encoding="utf-8") as index_handle:
+            for line in index_handle:
+                offset, length, raw_length = (int(part) for part in line.split())
+                if offset != (blocks[-1][0] + blocks[-1][1] if blocks else 0):
+                    return None
+                blocks.append((offset, length, raw_length))
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        return None
+    return blocks
+
+
+def _indexed_end(blocks: List[Block]) -> int:
+    return blocks[-1][0] + blocks[-1][1] if blocks else 0
+
+
+def _read_block(task: Tuple[Text, Text, int, int]) -> bytes:
+    filename, compression, offset, length = task
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        return decompress(f.read(length), compression)
+
+
+def _block_chunks(
+    filename: Text, compression: Text, blocks: List[Block], processes: int
+) -> Iterator[bytes]:
+    tasks = [(filename, compression, offset, length) for offset, length, _ in blocks]
+    if processes <= 1 or len(tasks) < 2:
+        for task in tasks:
+            yield _read_block(task)
+        return
+
+    # Keep a few blocks in flight per worker, in order, so memory stays
+    # bounded when the consumer is slower than decompression
+    executor = ProcessPoolExecutor(min(processes, len(tasks)))
+    try:
+        remaining = iter(tasks)
+        in_flight = deque()  # type: Deque[Future[bytes]]
+        for task in remaining:
+            in_flight.append(executor.submit(_read_block, task))
+            if len(in_flight) >= 2 * processes:
+                break
+        while in_flight:
+            chunk = in_flight.popleft().result()
+            next_task = next(remaining, None)
+            if next_task is not None:
+                in_flight.append(executor.submit(_read_block, next_task))
+            yield chunk
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def _decompress_tail(filename: Text, compression: Text, offset: int) -> Optional[bytes]:
+    """Data appended after the indexed blocks, or None if it doesn't
+    decompress (a block cut short by a crash)."""
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        tail = f.read()
+    try:
+        return decompress(tail, compression)
+    except (OSError, EOFError, lzma.LZMAError, ValueError):
+        return None
+
+
+def _tail_chunks(filename: Text, compression: Text, offset: int) -> Iterator[bytes]:
+    tail = _decompress_tail(filename, compression, offset)
+    if tail is None:
+        sys.stderr.write(
+            "{} ends in an incomplete compressed block; ignoring it\n".format(filename)
+        )
+        return
+    yield tail
+
+
+def _stream_chunks(filename: Text, compression: Text) -> Iterator[bytes]:
+    if compression == "gzip":
+        stream = gzip.open(filename, "rb")  # type: Any
+    elif compression == "xz":
+        stream = lzma.open(filename, "rb")
+    else:
+        stream = bz2.open(filename, "rb")
+    with stream as f:
+        while True:
+            try:
+                # Small reads, so a cut-off last block loses little
+                chunk = f.read(STREAM_READ_SIZE)
+            except EOFError:
+                sys.stderr.write(
+                    "{} ends in an incomplete compressed block; ignoring "
+                    "it\n".format(filename)
+                )
+                return
+            if not chunk:
+                return
+            yield chunk
+
+
+class _ChunkReader(io.RawIOBase):
+    """Raw stream over an iterator of decompressed chunks."""
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self.chunks = chunks
+        self.pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk)
+        length = min(len(buffer), len(self.pending))
+        buffer[:length] = self.pending[:length]
+        self.pending = self.pending[length:]
+        return length
+
+    def close(self) -> None:
+        if not self.closed:
+            close = getattr(self.chunks, "close", None)
+            if close:
+                close()
+        super().close()
+
+
+class _BlockWriter(io.RawIOBase):
+    """Writes line-aligned, independently compressed blocks and records each
+    one in a sidecar index once it is on disk."""
+
+    def __init__(
+        self, filename: Text, append: bool, compression: Text, block_size: int
+    ) -> None:
+        self.compression = compression
+        self.block_size = block_size
+        self.buffer = bytearray()
+        index_file = filename + INDEX_SUFFIX
+
+        offset = os.path.getsize(filename) if append and os.path.exists(filename) else 0
+        blocks = read_block_index(filename) if offset else []
+        if blocks is not None and _indexed_end(blocks) < offset:
+            # Whatever follows the indexed blocks is either a block cut short
+            # by a crash, which we drop, or data we know nothing about
+            end = _indexed_end(blocks)
+            if _decompress_tail(filename, compression, end) is not None:
+                blocks = None
+            else:
+                os.truncate(filename, end)
+                offset = end
+
+        self.handle = open(filename, "ab" if offset else "wb")
+        self.offset = offset
+        self.index_handle = None  # type: Optional[IO[Text]]
+        if blocks is not None:
+            self.index_handle = open(
+                index_file, "a" if offset else "w", encoding="utf-8"
+            )
+        elif os.path.exists(index_file):
+            # The index can't describe this file any more
+            os.unlink(index_file)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self.buffer += data
+        # Cut blocks at the first line end past block_size
+        start = 0
+        while len(self.buffer) - start >= self.block_size:
+            cut = self.buffer.find(b"\n", start + self.block_size - 1) + 1
+            if not cut:
+                break
+            self.write_block(bytes(self.buffer[start:cut]))
+            start = cut
+        del self.buffer[:start]
+        return len(data)
+
+    def write_block(self, raw: bytes) -> None:
+        block = compress(raw, self.compression)
+        self.handle.write(block)
+        self.handle.flush()
+        if self.index_handle:
+            self.index_handle.write(
+                "{} {} {}\n".format(self.offset, len(block), len(raw))
+            )
+            self.index_handle.flush()
+        self.offset += len(block)
+
+    def close(self) -> None:
+        if not self.closed:
+            if self.buffer:
+                self.write_block(bytes(self.buffer))
+                self.buffer.clear()
+            self.handle.close()
+            if self.index_handle:
+                self.index_handle.close()
+        super().close()
+
+
+def default_read_processes() -> int:
+    # Daemonic processes (e.g. multiprocessing.Pool workers) can't have children
+    if multiprocessing.current_process().daemon:
+        return 1
+    return min(os.cpu_count() or 1, MAX_READ_PROCESSES)
+
+
+def open_inventory(
+    filename: Text,
+    mode: Text = "r",
+    encoding: Optional[Text] = "utf-8",
+    errors: Optional[Text] = None,
+    compression: Optional[Text] = None,
+    processes: Optional[int] = None,
+    block_size: int = BLOCK_SIZE,
+) -> IO[Any]:
+    """Open an inventory that may be gzip, xz or bz2 compressed.
+
+    Reading ("r", "rb") detects the compression from magic bytes. Files with
+    a block index are decompressed block by block, across up to processes
+    worker processes; others are streamed. Writing ("w") compresses with
+    compression if given, and appending ("a") keeps whatever compression the
+    file already has. Compressed output goes out in independent blocks of
+    about block_size uncompressed bytes, listed in a <file>.blocks index.
+    """
+    assert mode in ("r", "rb", "w", "a"), "Unsupported mode " + mode
+    binary = None  # type: Optional[IO[bytes]]
+
+    if mode in ("r", "rb"):
+        detected = detect_compression(filename)
+        if detected is None:
+            if mode == "rb":
+                return open(filename, "rb")
+            return open(filename, "r", encoding=encoding, errors=errors)
+
+        blocks = read_block_index(filename)
+        size = os.path.getsize(filename)
+        if blocks is not None and _indexed_end(blocks) <= size:
+            chunks = _block_chunks(
+                filename,
+                detected,
+                blocks,
+                default_read_processes() if processes is None else processes,
+            )
+            if _indexed_end(blocks) < size:
+                chunks = itertools.chain(
+                    chunks, _tail_chunks(filename, detected, _indexed_end(blocks))
+                )
+        else:
+            chunks = _stream_chunks(filename, detected)
+        binary = io.BufferedReader(_ChunkReader(chunks), buffer_size=1024 * 1024)
+    else:
+        if mode == "a" and os.path.exists(filename) and os.path.getsize(filename):
+            compression = detect_compression(filename)
+        if compression is None:
+            if mode == "w" and os.path.exists(filename + INDEX_SUFFIX):
+                os.unlink(filename + INDEX_SUFFIX)
+            return open(filename, mode, encoding=encoding, errors=errors)
+        assert compression in COMPRESSIONS, "Unknown compression " + compression
+        binary = io.BufferedWriter(
+            _BlockWriter(filename, mode == "a", compression, block_size),
+            buffer_size=1024 * 1024,
+        )
+
+    if mode == "rb":
+        return binary
+    return io.TextIOWrapper(binary, encoding=encoding, errors=errors)
+
+
+def replace_inventory(source: Text, destination: Text) -> None:
+    """os.replace for an inventory together with its block index."""
+    os.replace(source, destination)
+    if os.path.exists(source + INDEX_SUFFIX):
+        os.replace(source + INDEX_SUFFIX, destination + INDEX_SUFFIX)
+    elif os.path.exists(destination + INDEX_SUFFIX):
+        os.unlink(destination + INDEX_SUFFIX)
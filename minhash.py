@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+from collections import defaultdict
+import random
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+# Mersenne prime used as the modulus of the universal hash family
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = MERSENNE_PRIME - 1
+DEFAULT_NUM_PERM = 128
+
+
+class MinHasher:
+    """Produces fixed-size MinHash sketches of sets of file digests.
+
+    Sketches of subsets combine with an element-wise min, so a directory's
+    sketch can be built from its files and its subdirectories' sketches
+    without ever holding the set of digests below it.
+    """
+
+    def __init__(self, num_perm: int = DEFAULT_NUM_PERM, seed: int = 1) -> None:
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.permutations = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]  # type: List[Tuple[int, int]]
+
+    def empty(self) -> List[int]:
+        return [MAX_HASH] * self.num_perm
+
+    def hash_values(self, digest: int) -> List[int]:
+        x = digest % MERSENNE_PRIME
+        return [(a * x + b) % MERSENNE_PRIME for a, b in self.permutations]
+
+    def sketch(self, digests: Iterable[int]) -> List[int]:
+        sketch = self.empty()
+        for digest in digests:
+            sketch = merge(sketch, self.hash_values(digest))
+        return sketch
+
+
+def merge(first: Sequence[int], second: Sequence[int]) -> List[int]:
+    return [a if a < b else b for a, b in zip(first, second)]
+
+
+def is_empty(sketch: Sequence[int]) -> bool:
+    return sketch[0] == MAX_HASH and all(value == MAX_HASH for value in sketch)
+
+
+def jaccard(first: Sequence[int], second: Sequence[int]) -> float:
+    """Estimated Jaccard similarity of the two sets behind the sketches."""
+    matches = sum(1 for a, b in zip(first, second) if a == b)
+    return matches / len(first)
+
+
+def choose_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """Pick (bands, rows) with bands * rows <= num_perm so that the LSH
+    S-curve, whose midpoint is about (1 / bands) ** (1 / rows), is
+    closest to the requested threshold."""
+    best = (num_perm, 1)
+    best_error = None  # type: Optional[float]
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best_error is None or error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+
+class LSHIndex:
+    """Banded locality sensitive hashing over MinHash sketches."""
+
+    def __init__(self, num_perm: int, threshold: float) -> None:
+        self.threshold = threshold
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+        self.buckets = [
+            defaultdict(list) for _ in range(self.bands)
+        ]  # type: List[Dict[Tuple[int, ...], List[int]]]
+        self.sketches = []  # type: List[Sequence[int]]
+
+    def add(self, sketch: Sequence[int]) -> int:
+        key = len(self.sketches)
+        self.sketches.append(sketch)
+        for band in range(self.bands):
+            start = band * self.rows
+            self.buckets[band][tuple(sketch[start : start + self.rows])].append(key)
+        return key
+
+    def similar_pairs(self) -> List[Tuple[float, int, int]]:
+        """Return (estimated similarity, key, key) for candidate pairs at or
+        above the threshold, most similar first."""
+        candidates = set()  # type: Set[Tuple[int, int]]
+        for buckets in self.buckets:
+            for keys in buckets.values():
+                if len(keys) < 2:
+                    continue
+                for i, first in enumerate(keys):
+                    for second in keys[i + 1 :]:
+                        candidates.add((first, second))
+
+        pairs = []  # type: List[Tuple[float, int, int]]
+        for first, second in candidates:
+            similarity = jaccard(self.sketches[first], self.sketches[second])
+            if similarity >= self.threshold:
+                pairs.append((similarity, first, second))
+        pairs.sort(reverse=True)
+        return pairs
@@ -0,0 +1,327 @@
+import heapq
+from os import path
+import sys
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Text,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+import numpy as np
+
+from inventory_io import open_inventory
+from profiling import NULL_PROFILER, NullProfiler
+
+
+V = TypeVar("V")
+
+
+def _runs(*keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Start and end offsets of the runs of equal rows in sorted key arrays."""
+    length = len(keys[0])
+    if length == 0:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty
+    changed = np.zeros(length - 1, dtype=bool)
+    for key in keys:
+        changed |= key[1:] != key[:-1]
+    boundaries = np.flatnonzero(changed) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [length]))
+    return starts, ends
+
+
+def digest_lanes(digests: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Split 128-bit digests into high and low uint64 lanes."""
+    mask = (1 << 64) - 1
+    high = np.fromiter((digest >> 64 for digest in digests), np.uint64, len(digests))
+    low = np.fromiter((digest & mask for digest in digests), np.uint64, len(digests))
+    return high, low
+
+
+def duplicate_groups(
+    sizes: Union[Sequence[int], np.ndarray],
+    lanes_of: Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]],
+) -> Tuple[List[int], List[Tuple[int, int]]]:
+    """Find groups of entries with equal size and digest.
+
+    Sizes are grouped first, so lanes_of is only asked for the digest lanes
+    of the entries whose size is shared (which a walked tree hashes lazily).
+    Returns an order of entry indices and the (start, end) ranges of each
+    group within it. Groups come in the order file_dupes' dicts would produce
+    them (by first appearance of their size, then of their digest) and list
+    their entries in input order.
+    """
+    size_array = np.asarray(sizes, dtype=np.uint64)
+    _, first_of_size, size_ids = np.unique(
+        size_array, return_index=True, return_inverse=True
+    )
+    members, starts, ends = _sorted_groups(size_array, lanes_of)
+    if len(members) == 0:
+        return [], []
+
+    first_members = members[starts]
+    group_order = np.lexsort((first_members, first_of_size[size_ids[first_members]]))
+    ranges = list(zip(starts[group_order].tolist(), ends[group_order].tolist()))
+    return members.tolist(), ranges
+
+
+def _sorted_groups(
+    size_array: np.ndarray,
+    lanes_of: Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Entries of duplicate groups sorted by (size, digest), then input order,
+    and the (start, end) offsets of each group within them."""
+    _, size_ids, size_counts = np.unique(
+        size_array, return_inverse=True, return_counts=True
+    )
+    candidates = np.flatnonzero(size_counts[size_ids] > 1)
+    if len(candidates) == 0:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty, empty
+
+    candidate_sizes = size_array[candidates]
+    high, low = lanes_of(candidates)
+    # lexsort is stable and sorts by its last key first
+    order = np.lexsort((low, high, candidate_sizes))
+    starts, ends = _runs(candidate_sizes[order], high[order], low[order])
+    keep = ends - starts > 1
+    starts, ends = starts[keep], ends[keep]
+
+    # Drop the entries of singleton runs and renumber the group offsets
+    lengths = ends - starts
+    positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    positions += np.arange(len(positions))
+    members = candidates[order[positions]]
+    ends = np.cumsum(lengths)
+    return members, ends - lengths, ends
+
+
+class _DirectoryIds:
+    """Numbers the directories under a root, with each one's parent and
+    depth, so per-file values can be rolled up with array operations."""
+
+    def __init__(self, root_path: Text) -> None:
+        self.root_path = root_path
+        self.ids = {path.normpath(root_path): 0}  # type: Dict[Text, int]
+        self.parents = [-1]
+        self.depths = [0]
+        self.display_paths = [root_path]
+
+    def id_of(self, dir_path: Text) -> int:
+        """Number of a normalized directory path, adding it and any missing
+        parents below the root."""
+        missing = []  # type: List[Text]
+        current = dir_path
+        while current not in self.ids:
+            missing.append(current)
+            parent = path.dirname(current)
+            assert parent != current, "{} is outside of {}".format(
+                dir_path, self.root_path
+            )
+            current = parent
+
+        parent_id = self.ids[current]
+        for missing_path in reversed(missing):
+            directory_id = len(self.parents)
+            self.ids[missing_path] = directory_id
+            self.parents.append(parent_id)
+            self.depths.append(self.depths[parent_id] + 1)
+            self.display_paths.append(
+                path.join(self.display_paths[parent_id], path.basename(missing_path))
+            )
+            parent_id = directory_id
+        return parent_id
+
+
+def _common_ancestors(
+    member_dirs: np.ndarray,
+    starts: np.ndarray,
+    lengths: np.ndarray,
+    parents: np.ndarray,
+    depths: np.ndarray,
+) -> np.ndarray:
+    """Deepest common directory of each group of member directories, found
+    for all groups at once by lifting members one level at a time."""
+    group_of = np.repeat(np.arange(len(starts)), lengths)
+    current = member_dirs.copy()
+    # First bring every member up to the shallowest depth in its group
+    target = np.minimum.reduceat(depths[current], starts)[group_of]
+    deeper = depths[current] > target
+    while deeper.any():
+        current[deeper] = parents[current[deeper]]
+        deeper = depths[current] > target
+    # Then lift whole groups until their members meet
+    while True:
+        split = np.minimum.reduceat(current, starts) != np.maximum.reduceat(
+            current, starts
+        )
+        if not split.any():
+            common_dirs = current[starts]  # type: np.ndarray
+            return common_dirs
+        lift = split[group_of]
+        current[lift] = parents[current[lift]]
+
+
+def _largest(items: List[Tuple[Any, V]], top: Optional[int]) -> List[Tuple[Any, V]]:
+    """The top (key, item) pairs by key, largest first; ties keep input order."""
+    if top is None:
+        return sorted(items, key=lambda item: item[0], reverse=True)
+    return heapq.nlargest(top, items, key=lambda item: item[0])
+
+
+def file_dupes_records(
+    root_path: Text,
+    hashes_file: Text,
+    sizes_file: Text,
+    profiler: NullProfiler = NULL_PROFILER,
+    top: Optional[int] = None,
+    min_size: int = 0,
+) -> None:
+    """Print duplicate files and entirely duplicated directories like
+    file_dupes, from hashes and sizes files, without building File objects.
+
+    Sizes and raw 16-byte digests go straight into arrays, and each file
+    only keeps its path and a directory number. Groups are found with sorts,
+    and directory totals are summed one depth level at a time. Files in a
+    group are listed in sizes file order, and ties between directories of
+    equal size may come out in a different order than file_dupes uses.
+    """
+    out = sys.stdout
+
+    with profiler.phase("load records"):
+        digests_by_path = dict()  # type: Dict[Text, bytes]
+        with open_inventory(hashes_file, "r", errors="replace") as file_in:
+            for line_no, line in enumerate(file_in, 1):
+                hex_digest, _, file_path = (
+                    line.strip().replace("\t", " ").partition(" ")
+                )
+                norm_path = path.normpath(file_path)
+                try:
+                    assert len(hex_digest) == 32, "Invalid hash"
+                    digests_by_path[norm_path] = bytes.fromhex(hex_digest)
+                except (AssertionError, ValueError):
+                    sys.stderr.write(
+                        "Failure on line {} ({}): {}/{}\n".format(
+                            line_no, line, hex_digest, norm_path
+                        )
+                    )
+
+        directories = _DirectoryIds(root_path)
+        file_paths = []  # type: List[Text]
+        file_sizes = []  # type: List[int]
+        file_digests = []  # type: List[bytes]
+        file_directories = []  # type: List[int]
+        with open_inventory(sizes_file, "r", errors="replace") as file_in:
+            for line_no, line in enumerate(file_in, 1):
+                size_str, _, file_path = line.strip().replace("\t", " ").partition(" ")
+                norm_path = path.normpath(file_path)
+                try:
+                    size = int(size_str)
+                except ValueError:
+                    sys.stderr.write(
+                        "Failure on line {} ({}): {}/{}\n".format(
+                            line_no, line, size_str, norm_path
+                        )
+                    )
+                    continue
+                file_digest = digests_by_path.get(norm_path)
+                if file_digest is None:
+                    sys.stderr.write("Hash missing for file {}\n".format(norm_path))
+                    continue
+                file_paths.append(norm_path)
+                file_sizes.append(size)
+                file_digests.append(file_digest)
+                file_directories.append(directories.id_of(path.dirname(norm_path)))
+        del digests_by_path
+
+        sizes = np.array(file_sizes, dtype=np.int64)
+        del file_sizes
+        lanes = np.frombuffer(b"".join(file_digests), dtype=">u8").reshape(-1, 2)
+        del file_digests
+        high = lanes[:, 0].astype(np.uint64)
+        low = lanes[:, 1].astype(np.uint64)
+        file_dirs = np.array(file_directories, dtype=np.intp)
+        del file_directories
+        parents = np.array(directories.parents, dtype=np.intp)
+        depths = np.array(directories.depths, dtype=np.intp)
+
+    with profiler.phase("hash and group"):
+        members, starts, ends = _sorted_groups(
+            sizes, lambda candidates: (high[candidates], low[candidates])
+        )
+        lengths = ends - starts
+
+    with profiler.phase("link dupes"):
+        is_dupe = np.zeros(len(sizes), dtype=bool)
+        is_dupe[members] = True
+        copied_elsewhere = np.zeros(len(sizes), dtype=bool)
+        if len(members):
+            # Unless all copies share one directory's subtree, each copy has
+            # one outside the subtree of any directory below their common one
+            member_dirs = file_dirs[members]
+            common_dirs = _common_ancestors(
+                member_dirs, starts, lengths, parents, depths
+            )
+            copied_elsewhere[members] = member_dirs != np.repeat(common_dirs, lengths)
+
+        # Largest (size, digest) first, like file_dupes' TopK
+        firsts = members[starts]
+        reported = np.lexsort((low[firsts], high[firsts], sizes[firsts]))[::-1]
+        reported = reported[sizes[firsts[reported]] >= min_size][:top]
+
+    with profiler.phase("roll up directories"):
+        directory_count = len(parents)
+        total_bytes = np.zeros(directory_count, dtype=np.int64)
+        np.add.at(total_bytes, file_dirs, sizes)
+        dupe_count = np.bincount(file_dirs, weights=is_dupe, minlength=directory_count)
+        uncopied_count = np.bincount(
+            file_dirs, weights=~copied_elsewhere, minlength=directory_count
+        )
+        for depth in range(int(depths.max()), 0, -1):
+            level = np.flatnonzero(depths == depth)
+            np.add.at(total_bytes, parents[level], total_bytes[level])
+            np.add.at(dupe_count, parents[level], dupe_count[level])
+            np.add.at(uncopied_count, parents[level], uncopied_count[level])
+
+    with profiler.phase("report files"):
+        out.write("------ FILES ------\n")
+        for group in reported.tolist():
+            first = firsts[group]
+            digest = (int(high[first]) << 64) | int(low[first])
+            out.write("{} bytes ({}): \n".format(sizes[first], digest))
+            group_members = members[starts[group] : ends[group]].tolist()
+            out.write(", ".join(file_paths[index] for index in group_members))
+            out.write("\n\n")
+
+    with profiler.phase("entirely duplicated"):
+        entirely_duplicated = uncopied_count == 0
+        parent_duplicated = np.zeros(directory_count, dtype=bool)
+        parent_duplicated[1:] = entirely_duplicated[parents[1:]]
+        candidates = np.flatnonzero(
+            (dupe_count > 0)
+            & entirely_duplicated
+            & ~parent_duplicated
+            & (total_bytes >= min_size)
+        )
+        dupe_directories = _largest(
+            list(zip(total_bytes[candidates].tolist(), candidates.tolist())), top
+        )
+
+    with profiler.phase("report directories"):
+        out.write("--- DIRECTORIES ---\n")
+        for total_size, directory_id in dupe_directories:
+            out.write(
+                "{} entirely duplicated ({} bytes)\n".format(
+                    directories.display_paths[directory_id], total_size
+                )
+            )
+
+    profiler.print_summary()
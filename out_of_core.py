@@ -0,0 +1,342 @@
+import itertools
+from os import path, sep
+import shutil
+import sys
+import tempfile
+from typing import Iterator, List, Optional, Text, TextIO, Tuple
+
+from external_sort import external_sort
+from inventory_io import open_inventory
+from profiling import NULL_PROFILER, NullProfiler
+
+
+# Rough bytes held per line in a sort run: the string, its list slot and the
+# key computed for it
+BYTES_PER_SORTED_LINE = 400
+DEFAULT_MEMORY_BUDGET = 1 << 30
+SIZE_SUFFIXES = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(text: Text) -> int:
+    """Parse a byte count such as 512M or 4G."""
+    text = text.strip().upper().rstrip("B")
+    suffix = text[-1:] if text[-1:] in SIZE_SUFFIXES else ""
+    return int(float(text[: len(text) - len(suffix)]) * SIZE_SUFFIXES[suffix])
+
+
+def max_lines_for(memory_budget: int) -> int:
+    return max(1000, memory_budget // BYTES_PER_SORTED_LINE)
+
+
+def _components(dir_path: Text) -> List[Text]:
+    return [component for component in dir_path.split(sep) if component]
+
+
+def _tagged_records(filename: Text, kind: Text) -> Iterator[Text]:
+    """Yield "<path>\\0<kind>\\0<value>\\n" for each valid "<value> <path>"
+    line, reporting bad lines the same way the in-memory loaders do."""
+    with open_inventory(filename, "r", errors="replace") as file_in:
+        for line_no, line in enumerate(file_in, 1):
+            value, _, file_path = line.strip().replace("\t", " ").partition(" ")
+            norm_path = path.normpath(file_path)
+            try:
+                if kind == "h":
+                    assert len(value) == 32, "Invalid hash"
+                    int(value, 16)
+                else:
+                    int(value)
+            except:
+                sys.stderr.write(
+                    "Failure on line {} ({}): {}/{}\n".format(
+                        line_no, line, value, norm_path
+                    )
+                )
+                continue
+            yield "{}\0{}\0{}\n".format(norm_path, kind, value)
+
+
+def _joined_records(tagged: Iterator[Text]) -> Iterator[Text]:
+    """Turn path-sorted tagged records into "<size>\\0<digest>\\0<path>\\n",
+    keeping the last hash and size seen for each path."""
+    for file_path, records in itertools.groupby(
+        tagged, key=lambda record: record.partition("\0")[0]
+    ):
+        digest = None  # type: Optional[Text]
+        size = None  # type: Optional[Text]
+        for record in records:
+            _, kind, value = record.rstrip("\n").split("\0")
+            if kind == "h":
+                digest = value
+            else:
+                size = value
+        if size is None:
+            continue
+        if digest is None:
+            sys.stderr.write("Hash missing for file {}\n".format(file_path))
+            continue
+        yield "{}\0{}\0{}\n".format(int(size), digest, file_path)
+
+
+def _parse_joined(line: Text) -> Tuple[int, Text, Text]:
+    size, digest, file_path = line.rstrip("\n").split("\0", 2)
+    return int(size), digest, file_path
+
+
+def _largest_first(line: Text) -> Tuple[int, int]:
+    size, digest, _ = line.split("\0", 2)
+    return -int(size), -int(digest, 16)
+
+
+class _Frame:
+    """Running totals for one open directory during the rollup pass."""
+
+    __slots__ = ("name", "display_path", "total_bytes", "all_ok", "candidates")
+
+    def __init__(self, name: Text, display_path: Text) -> None:
+        self.name = name
+        self.display_path = display_path
+        self.total_bytes = 0
+        # Every file below has a copy outside its own directory's subtree
+        self.all_ok = True
+        # Entirely duplicated subdirectories, reported unless this is too
+        self.candidates = []  # type: List[Tuple[int, Text]]
+
+
+class _Rollup:
+    """Walks path-sorted file records with a stack of open directories.
+
+    A directory's subtree is contiguous in path order, so it is complete when
+    it is popped. A directory is entirely duplicated when all its files are,
+    and it is reported when its parent is not.
+    """
+
+    def __init__(self, root_path: Text, reports: TextIO) -> None:
+        self.root_path = root_path
+        self.root_components = _components(path.normpath(root_path))
+        self.reports = reports
+        self.stack = []  # type: List[_Frame]
+
+    def add(self, file_path: Text, size: int, ok: bool) -> None:
+        dir_components = _components(path.dirname(file_path))
+        depth = len(self.root_components)
+        if dir_components[:depth] != self.root_components:
+            sys.stderr.write(
+                "File outside of {}: {}\n".format(self.root_path, file_path)
+            )
+            return
+        relative = dir_components[depth:]
+
+        if not self.stack:
+            self.stack.append(_Frame("", self.root_path))
+        common = 0
+        while (
+            common < len(relative)
+            and common + 1 < len(self.stack)
+            and self.stack[common + 1].name == relative[common]
+        ):
+            common += 1
+        while len(self.stack) > common + 1:
+            self.close()
+        for index in range(common, len(relative)):
+            self.stack.append(
+                _Frame(
+                    relative[index], path.join(self.root_path, *relative[: index + 1])
+                )
+            )
+
+        frame = self.stack[-1]
+        frame.total_bytes += size
+        if not ok:
+            self.mark_not_duplicated(frame)
+
+    def mark_not_duplicated(self, frame: _Frame) -> None:
+        if not frame.all_ok:
+            return
+        frame.all_ok = False
+        for total_bytes, display_path in frame.candidates:
+            self.report(total_bytes, display_path)
+        frame.candidates = []
+
+    def report(self, total_bytes: int, display_path: Text) -> None:
+        self.reports.write("{}\0{}\n".format(total_bytes, display_path))
+
+    def close(self) -> None:
+        frame = self.stack.pop()
+        parent = self.stack[-1] if self.stack else None
+        if parent is None:
+            if frame.all_ok:
+                self.report(frame.total_bytes, frame.display_path)
+            return
+
+        parent.total_bytes += frame.total_bytes
+        if not frame.all_ok:
+            self.mark_not_duplicated(parent)
+        elif parent.all_ok:
+            parent.candidates.append((frame.total_bytes, frame.display_path))
+        else:
+            self.report(frame.total_bytes, frame.display_path)
+
+    def finish(self) -> None:
+        while self.stack:
+            self.close()
+
+
+def file_dupes_out_of_core(
+    root_path: Text,
+    hashes_file: Text,
+    sizes_file: Text,
+    max_lines: int,
+    tmp_dir: Optional[Text] = None,
+    profiler: NullProfiler = NULL_PROFILER,
+    top: Optional[int] = None,
+    min_size: int = 0,
+) -> None:
+    """Print duplicate files and entirely duplicated directories like
+    file_dupes, without holding the inventory in memory.
+
+    The records are externally sorted by path to join hashes with sizes, then
+    by (size, digest) so duplicate groups stream past one at a time. Each file
+    is flagged with whether a copy exists outside its own directory's subtree
+    (the deepest common directory of its group sits above it), and a final
+    path-sorted pass rolls the flags and sizes up the directory tree. At most
+    max_lines lines are sorted in memory at once.
+
+    Files in a group are listed in path order, and ties between groups or
+    directories of equal size may come out in a different order than
+    file_dupes uses.
+    """
+    out = sys.stdout
+    work_dir = tempfile.mkdtemp(prefix="dupe-finder-", dir=tmp_dir)
+    joined_file = path.join(work_dir, "joined.txt")
+    by_size_file = path.join(work_dir, "by_size.txt")
+    flags_file = path.join(work_dir, "flags.txt")
+    reports_file = path.join(work_dir, "directories.txt")
+
+    try:
+        with profiler.phase("join records"):
+            tagged = external_sort(
+                itertools.chain(
+                    _tagged_records(hashes_file, "h"), _tagged_records(sizes_file, "s")
+                ),
+                lambda record: record.partition("\0")[0],
+                max_lines,
+                work_dir,
+            )
+            with open(
+                joined_file, "w", encoding="utf-8", errors="surrogateescape"
+            ) as joined_handle:
+                joined_handle.writelines(_joined_records(tagged))
+
+        with profiler.phase("sort by size"):
+            with open(
+                joined_file, encoding="utf-8", errors="surrogateescape"
+            ) as joined_handle:
+                with open(
+                    by_size_file, "w", encoding="utf-8", errors="surrogateescape"
+                ) as by_size_handle:
+                    by_size_handle.writelines(
+                        external_sort(
+                            joined_handle, _largest_first, max_lines, work_dir
+                        )
+                    )
+
+        # Two readers over the same file: the first finds each group's size
+        # and common directory, the second then flags and reports its members
+        with profiler.phase("group dupes"):
+            out.write("------ FILES ------\n")
+            reported = 0
+            with open(
+                by_size_file, encoding="utf-8", errors="surrogateescape"
+            ) as lead_handle, open(
+                by_size_file, encoding="utf-8", errors="surrogateescape"
+            ) as trail_handle, open(
+                flags_file, "w", encoding="utf-8", errors="surrogateescape"
+            ) as flags_handle:
+                trail = map(_parse_joined, trail_handle)
+                for (size, digest), members in itertools.groupby(
+                    map(_parse_joined, lead_handle), key=lambda r: (r[0], r[1])
+                ):
+                    count = 0
+                    common = None  # type: Optional[List[Text]]
+                    for _, _, file_path in members:
+                        count += 1
+                        components = _components(path.dirname(file_path))
+                        if common is None:
+                            common = components
+                        else:
+                            common = [
+                                a
+                                for a, b in itertools.takewhile(
+                                    lambda pair: pair[0] == pair[1],
+                                    zip(common, components),
+                                )
+                            ]
+                    assert common is not None
+
+                    report = (
+                        count > 1
+                        and size >= min_size
+                        and (top is None or reported < top)
+                    )
+                    if report:
+                        out.write("{} bytes ({}): \n".format(size, int(digest, 16)))
+                        reported += 1
+                    for index in range(count):
+                        _, _, file_path = next(trail)
+                        ok = count > 1 and len(common) < len(
+                            _components(path.dirname(file_path))
+                        )
+                        flags_handle.write(
+                            "{}\0{}\0{}\n".format(file_path, size, int(ok))
+                        )
+                        if report:
+                            if index:
+                                out.write(", ")
+                            out.write(file_path)
+                    if report:
+                        out.write("\n\n")
+
+        with profiler.phase("entirely duplicated"):
+            with open(
+                flags_file, encoding="utf-8", errors="surrogateescape"
+            ) as flags_handle, open(
+                reports_file, "w", encoding="utf-8", errors="surrogateescape"
+            ) as reports_handle:
+                rollup = _Rollup(root_path, reports_handle)
+                for line in external_sort(
+                    flags_handle,
+                    lambda record: record.partition("\0")[0],
+                    max_lines,
+                    work_dir,
+                ):
+                    file_path, size_text, flag = line.rstrip("\n").split("\0")
+                    rollup.add(file_path, int(size_text), flag == "1")
+                rollup.finish()
+
+        with profiler.phase("report directories"):
+            out.write("--- DIRECTORIES ---\n")
+            with open(
+                reports_file, encoding="utf-8", errors="surrogateescape"
+            ) as reports_handle:
+                reported = 0
+                for line in external_sort(
+                    reports_handle,
+                    lambda record: -int(record.partition("\0")[0]),
+                    max_lines,
+                    work_dir,
+                ):
+                    total_size, display_path = line.rstrip("\n").split("\0", 1)
+                    if int(total_size) < min_size:
+                        continue
+                    if top is not None and reported >= top:
+                        break
+                    out.write(
+                        "{} entirely duplicated ({} bytes)\n".format(
+                            display_path, total_size
+                        )
+                    )
+                    reported += 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    profiler.print_summary()
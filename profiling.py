@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import argparse
+import cProfile
+from contextlib import contextmanager, nullcontext
+import io
+from os import makedirs, path
+import pstats
+import sys
+from time import perf_counter
+import tracemalloc
+from typing import ContextManager, Dict, Generator, List, Optional, TextIO, Text
+
+
+_NULL_PHASE = nullcontext()
+
+
+class PhaseStats:
+    def __init__(self, name: Text) -> None:
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.peak_memory = 0  # bytes, only with tracemalloc
+        self.cprofile = None  # type: Optional[cProfile.Profile]
+
+
+class NullProfiler:
+    """Stand-in used when profiling is off; every hook is a no-op."""
+
+    enabled = False
+
+    def phase(self, name: Text) -> ContextManager[None]:
+        # One shared, reusable context manager keeps disabled hooks cheap
+        return _NULL_PHASE
+
+    def print_summary(self, stream: Optional[TextIO] = None) -> None:
+        pass
+
+
+class Profiler(NullProfiler):
+    """Accumulates wall time per named phase.
+
+    Phases may be entered many times (e.g. once per hashed file) and their
+    times add up. With use_cprofile, each phase gets its own cProfile.Profile;
+    with use_tracemalloc, the peak traced memory seen inside each phase is
+    kept. Both captures only apply to the outermost phase when phases nest.
+    """
+
+    enabled = True
+
+    def __init__(
+        self,
+        use_cprofile: bool = False,
+        use_tracemalloc: bool = False,
+        cprofile_dir: Optional[Text] = None,
+    ) -> None:
+        self.use_cprofile = use_cprofile
+        self.use_tracemalloc = use_tracemalloc
+        self.cprofile_dir = cprofile_dir
+        self.phases = dict()  # type: Dict[Text, PhaseStats]
+        self.order = []  # type: List[Text]
+        self.depth = 0
+        self.started = perf_counter()
+        if use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stats(self, name: Text) -> PhaseStats:
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = PhaseStats(name)
+            self.order.append(name)
+        return stats
+
+    def phase(self, name: Text) -> ContextManager[None]:
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name: Text) -> Generator[None, None, None]:
+        stats = self._stats(name)
+        outermost = self.depth == 0
+        self.depth += 1
+
+        capture_cprofile = self.use_cprofile and outermost
+        if capture_cprofile:
+            if stats.cprofile is None:
+                stats.cprofile = cProfile.Profile()
+            stats.cprofile.enable()
+        capture_memory = self.use_tracemalloc and outermost
+        if capture_memory:
+            tracemalloc.reset_peak()
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            stats.seconds += perf_counter() - start
+            stats.calls += 1
+            if capture_cprofile:
+                assert stats.cprofile
+                stats.cprofile.disable()
+            if capture_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                stats.peak_memory = max(stats.peak_memory, peak)
+            self.depth -= 1
+
+    def summary(self) -> Text:
+        total = perf_counter() - self.started
+        lines = []
+        header = "{:<24} {:>10} {:>12} {:>7}".format("phase", "calls", "seconds", "%")
+        if self.use_tracemalloc:
+            header += " {:>12}".format("peak MB")
+        lines.append(header)
+        lines.append("-" * len(header))
+        for name in self.order:
+            stats = self.phases[name]
+            line = "{:<24} {:>10} {:>12.3f} {:>6.1f}%".format(
+                name, stats.calls, stats.seconds, 100 * stats.seconds / max(total, 1e-9)
+            )
+            if self.use_tracemalloc:
+                line += " {:>12.1f}".format(stats.peak_memory / 1024 / 1024)
+            lines.append(line)
+        lines.append("{:<24} {:>10} {:>12.3f}".format("total", "", total))
+        return "\n".join(lines)
+
+    def print_summary(self, stream: Optional[TextIO] = None) -> None:
+        stream = stream or sys.stderr
+        stream.write(self.summary() + "\n")
+
+        if not self.use_cprofile:
+            return
+        if self.cprofile_dir:
+            makedirs(self.cprofile_dir, exist_ok=True)
+        for name in self.order:
+            profile = self.phases[name].cprofile
+            if profile is None:
+                continue
+            if self.cprofile_dir:
+                filename = path.join(
+                    self.cprofile_dir, name.replace(" ", "_") + ".prof"
+                )
+                profile.dump_stats(filename)
+                stream.write(
+                    "Wrote cProfile data for {} to {}\n".format(name, filename)
+                )
+            else:
+                buffer = io.StringIO()
+                pstats.Stats(profile, stream=buffer).sort_stats(
+                    "cumulative"
+                ).print_stats(10)
+                stream.write("\n=== {} ===\n{}".format(name, buffer.getvalue()))
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def add_profiling_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--profile",
+        help="print a per-phase timing table at the end (on stderr)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cprofile",
+        help="also capture cProfile data for each phase (implies --profile)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cprofile-dir",
+        help="write per-phase cProfile dumps here instead of printing them",
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        help="also track peak memory for each phase (implies --profile)",
+        action="store_true",
+    )
+
+
+def profiler_from_args(args: argparse.Namespace) -> NullProfiler:
+    if args.profile or args.cprofile or args.cprofile_dir or args.tracemalloc:
+        return Profiler(
+            use_cprofile=bool(args.cprofile or args.cprofile_dir),
+            use_tracemalloc=args.tracemalloc,
+            cprofile_dir=args.cprofile_dir,
+        )
+    return NULL_PROFILER
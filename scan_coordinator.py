@@ -0,0 +1,360 @@
+import argparse
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+from time import time
+from typing import List, Optional, Text, Tuple
+
+from find_hashes_and_sizes import DiskReader
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    path BLOB NOT NULL,
+    recursive INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    completed_attempt INTEGER
+);
+CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_expires);
+"""
+
+
+def connect(database: Text) -> sqlite3.Connection:
+    # Autocommit; claims take an explicit write lock with BEGIN IMMEDIATE
+    connection = sqlite3.connect(database, timeout=60, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(units)")]
+    if "completed_attempt" not in columns:
+        # Queues made before attempts had their own fragments
+        connection.execute("ALTER TABLE units ADD COLUMN completed_attempt INTEGER")
+    return connection
+
+
+def fragments_dir(database: Text) -> Text:
+    return os.path.abspath(database) + ".fragments"
+
+
+def fragment_files(database: Text, unit_id: int, attempt: int) -> Tuple[Text, Text]:
+    """Inventory files of one attempt at a unit. Attempts never share files,
+    so a stalled worker that lost its lease can't write into its successor's."""
+    base = os.path.join(
+        fragments_dir(database), "unit-{:08d}-{:04d}".format(unit_id, attempt)
+    )
+    return base + "_hashes.txt", base + "_sizes.txt"
+
+
+def plan_units(directory: bytes, split_depth: int) -> List[Tuple[bytes, bool]]:
+    """Cut the tree into (path, recursive) work units.
+
+    Directories at split_depth below directory are scanned recursively as one
+    unit each. Directories above that depth only contribute the files directly
+    inside them, so every file belongs to exactly one unit.
+    """
+    units = []  # type: List[Tuple[bytes, bool]]
+    pending = [(directory, 0)]
+    while pending:
+        current, depth = pending.pop()
+        if depth >= split_depth:
+            units.append((current, True))
+            continue
+
+        units.append((current, False))
+        try:
+            entries = list(os.scandir(current))
+        except OSError as error:
+            print("Cannot split {}: {}".format(os.fsdecode(current), error))
+            units[-1] = (current, True)
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append((entry.path, depth + 1))
+    units.sort()
+    return units
+
+
+def init(database: Text, directory: Text, split_depth: int) -> None:
+    connection = connect(database)
+    existing = connection.execute("SELECT COUNT(*) FROM units").fetchone()[0]
+    assert not existing, "{} already has {} units".format(database, existing)
+
+    os.makedirs(fragments_dir(database), exist_ok=True)
+    units = plan_units(os.fsencode(os.path.abspath(directory)), split_depth)
+    connection.execute("BEGIN IMMEDIATE")
+    connection.executemany(
+        "INSERT INTO units (path, recursive) VALUES (?, ?)",
+        [(path_bytes, int(recursive)) for path_bytes, recursive in units],
+    )
+    connection.execute("COMMIT")
+    print("Queued {} units".format(len(units)))
+
+
+def claim(
+    connection: sqlite3.Connection, worker: Text, lease_seconds: float
+) -> Optional[Tuple[int, bytes, bool, int]]:
+    """Atomically take a pending unit, or one whose lease ran out because
+    its worker died. Returns (id, path, recursive, attempts) or None."""
+    now = time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            "SELECT id, path, recursive, attempts FROM units "
+            "WHERE state = 'pending' OR (state = 'claimed' AND lease_expires < ?) "
+            "ORDER BY id LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is None:
+            connection.execute("COMMIT")
+            return None
+        connection.execute(
+            "UPDATE units SET state = 'claimed', worker = ?, lease_expires = ?, "
+            "attempts = attempts + 1 WHERE id = ?",
+            (worker, now + lease_seconds, row[0]),
+        )
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    return row[0], bytes(row[1]), bool(row[2]), row[3]
+
+
+def copy_complete_lines(source: Text, destination: Text) -> None:
+    """Copy a fragment left by an earlier attempt, without a trailing
+    unterminated line, so the next attempt can resume from it."""
+    if not os.path.exists(source):
+        return
+    shutil.copyfile(source, destination)
+    with open(destination, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                f.truncate(start + newline + 1)
+                return
+            end = start
+        f.truncate(0)
+
+
+def work(database: Text, worker: Text, lease_seconds: float) -> None:
+    connection = connect(database)
+    while True:
+        unit = claim(connection, worker, lease_seconds)
+        if unit is None:
+            print("No units left to claim")
+            return
+
+        unit_id, path_bytes, recursive, attempts = unit
+        # The attempt number fences every later write to this unit's row
+        attempt = attempts + 1
+        print(
+            "Unit {}: {}{}".format(
+                unit_id,
+                path_bytes.decode("utf-8", errors="replace"),
+                "" if recursive else " (files only)",
+            )
+        )
+        hashes_file, sizes_file = fragment_files(database, unit_id, attempt)
+        if attempts:
+            # Reclaimed: resume from a copy of the latest earlier fragment
+            for previous in range(attempts, 0, -1):
+                previous_hashes_file, previous_sizes_file = fragment_files(
+                    database, unit_id, previous
+                )
+                if os.path.exists(previous_hashes_file):
+                    copy_complete_lines(previous_hashes_file, hashes_file)
+                    copy_complete_lines(previous_sizes_file, sizes_file)
+                    break
+
+        stop_heartbeat = threading.Event()
+        lease_lost = threading.Event()
+        heartbeat = threading.Thread(
+            target=keep_lease,
+            args=(
+                database,
+                unit_id,
+                attempt,
+                lease_seconds,
+                stop_heartbeat,
+                lease_lost,
+            ),
+            daemon=True,
+        )
+        heartbeat.start()
+        try:
+            reader = DiskReader(
+                path_bytes,
+                hashes_file,
+                sizes_file,
+                False,
+                False,
+                recursive=recursive,
+                stop=lease_lost,
+            )
+            completed = reader.run()
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+
+        if lease_lost.is_set():
+            print("Lost the lease on unit {}; leaving it to others".format(unit_id))
+            continue
+
+        if not completed:
+            # Hand the unit back; whoever claims it next resumes the fragment
+            connection.execute(
+                "UPDATE units SET state = 'pending', worker = NULL, "
+                "lease_expires = NULL WHERE id = ? AND attempts = ?",
+                (unit_id, attempt),
+            )
+            print("Interrupted; unit {} returned to the queue".format(unit_id))
+            return
+
+        finished = connection.execute(
+            "UPDATE units SET state = 'done', lease_expires = NULL, "
+            "completed_attempt = ? WHERE id = ? AND attempts = ? "
+            "AND state = 'claimed'",
+            (attempt, unit_id, attempt),
+        ).rowcount
+        if not finished:
+            print("Unit {} was reclaimed before it finished".format(unit_id))
+
+
+def keep_lease(
+    database: Text,
+    unit_id: int,
+    attempt: int,
+    lease_seconds: float,
+    stop: threading.Event,
+    lease_lost: threading.Event,
+) -> None:
+    """Extend the lease until stopped. Sets lease_lost, which stops the scan,
+    if the unit was reclaimed or the lease can't be extended."""
+    try:
+        connection = connect(database)
+        try:
+            while not stop.wait(lease_seconds / 3):
+                extended = connection.execute(
+                    "UPDATE units SET lease_expires = ? "
+                    "WHERE id = ? AND attempts = ? AND state = 'claimed'",
+                    (time() + lease_seconds, unit_id, attempt),
+                ).rowcount
+                if not extended:
+                    lease_lost.set()
+                    return
+        finally:
+            connection.close()
+    except Exception as error:
+        print("Cannot extend the lease on unit {}: {}".format(unit_id, error))
+        lease_lost.set()
+
+
+def status(database: Text) -> int:
+    connection = connect(database)
+    rows = connection.execute(
+        "SELECT state, COUNT(*) FROM units GROUP BY state ORDER BY state"
+    ).fetchall()
+    for state, count in rows:
+        print("{}: {}".format(state, count))
+    expired = connection.execute(
+        "SELECT COUNT(*) FROM units WHERE state = 'claimed' AND lease_expires < ?",
+        (time(),),
+    ).fetchone()[0]
+    if expired:
+        print(
+            "{} claimed units have expired leases and can be reclaimed".format(expired)
+        )
+    return sum(count for state, count in rows if state != "done")
+
+
+def merge(database: Text, hashes_file: Text, sizes_file: Text, force: bool) -> None:
+    connection = connect(database)
+    unfinished = connection.execute(
+        "SELECT COUNT(*) FROM units WHERE state != 'done'"
+    ).fetchone()[0]
+    assert force or not unfinished, "{} units are not done yet".format(unfinished)
+
+    units = connection.execute(
+        "SELECT id, completed_attempt FROM units WHERE state = 'done' ORDER BY id"
+    ).fetchall()
+    with open(hashes_file, "wb") as hashes_out, open(sizes_file, "wb") as sizes_out:
+        for unit_id, completed_attempt in units:
+            unit_hashes_file, unit_sizes_file = fragment_files(
+                database, unit_id, completed_attempt
+            )
+            for fragment, out in (
+                (unit_hashes_file, hashes_out),
+                (unit_sizes_file, sizes_out),
+            ):
+                if os.path.exists(fragment):
+                    with open(fragment, "rb") as fragment_in:
+                        for line in fragment_in:
+                            out.write(line)
+    print("Merged {} units into {} and {}".format(len(units), hashes_file, sizes_file))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split a scan into work units that any number of workers "
+        "can claim from a shared SQLite queue, then merge their inventories"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = subparsers.add_parser("init", help="queue work units for a tree")
+    init_parser.add_argument("database", help="queue database path")
+    init_parser.add_argument("directory", help="root directory for searching")
+    init_parser.add_argument(
+        "-d",
+        "--split-depth",
+        type=int,
+        default=1,
+        help="depth at which subtrees become separate units (default: 1)",
+    )
+
+    work_parser = subparsers.add_parser("work", help="claim and scan units")
+    work_parser.add_argument("database", help="queue database path")
+    work_parser.add_argument(
+        "-w",
+        "--worker-id",
+        default="{}:{}".format(socket.gethostname(), os.getpid()),
+        help="name recorded on claimed units (default: host:pid)",
+    )
+    work_parser.add_argument(
+        "-l",
+        "--lease",
+        type=float,
+        default=300,
+        help="seconds without a heartbeat before a unit can be reclaimed",
+    )
+
+    status_parser = subparsers.add_parser("status", help="show queue progress")
+    status_parser.add_argument("database", help="queue database path")
+
+    merge_parser = subparsers.add_parser("merge", help="combine unit inventories")
+    merge_parser.add_argument("database", help="queue database path")
+    merge_parser.add_argument("hashes_file", help="merged hashes file path")
+    merge_parser.add_argument("sizes_file", help="merged sizes file path")
+    merge_parser.add_argument(
+        "-f",
+        "--force",
+        help="merge finished units even if some are still pending",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    if args.command == "init":
+        init(args.database, args.directory, args.split_depth)
+    elif args.command == "work":
+        work(args.database, args.worker_id, args.lease)
+    elif args.command == "status":
+        sys.exit(1 if status(args.database) else 0)
+    else:
+        merge(args.database, args.hashes_file, args.sizes_file, args.force)
@@ -0,0 +1,340 @@
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import stat
+import struct
+import sys
+from time import monotonic
+from typing import Dict, Iterator, Optional, Text, Tuple
+
+from compact_inventory import compact
+from external_sort import DEFAULT_MAX_LINES
+from find_hashes_and_sizes import DiskReader
+from inventory_io import open_inventory
+
+
+# linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class WatchOverflow(Exception):
+    pass
+
+
+class Inotify:
+    """Minimal recursive inotify wrapper over libc through ctypes."""
+
+    def __init__(self) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.paths_by_wd = dict()  # type: Dict[int, bytes]
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def add_watch(self, directory: bytes) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, directory, WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(
+                    error,
+                    "Out of inotify watches; raise fs.inotify.max_user_watches",
+                )
+            # The directory may already be gone again
+            if error not in (errno.ENOENT, errno.ENOTDIR):
+                raise OSError(error, os.strerror(error))
+            return
+        self.paths_by_wd[wd] = directory
+
+    def add_tree(self, directory: bytes) -> Iterator[bytes]:
+        """Watch directory and everything below it, yielding the files seen,
+        which may have been created before their directory's watch existed."""
+        for root_bytes, _, files_bytes in os.walk(directory):
+            self.add_watch(root_bytes)
+            for name_bytes in files_bytes:
+                yield os.path.join(root_bytes, name_bytes)
+
+    def read_events(self, timeout: float) -> Iterator[Tuple[int, bytes]]:
+        """Yield (mask, path) for each event, waiting up to timeout seconds."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + name_length].rstrip(b"\0")
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                raise WatchOverflow()
+            directory = self.paths_by_wd.get(wd)
+            if mask & IN_IGNORED:
+                self.paths_by_wd.pop(wd, None)
+                continue
+            if directory is None:
+                continue
+            yield mask, os.path.join(directory, name) if name else directory
+
+
+class InventoryWatcher:
+    """Keeps a DiskReader inventory up to date from inotify events.
+
+    Changed paths are queued and rehashed once they have been quiet for
+    debounce seconds, then appended to the inventory. Records for deleted
+    files are cleaned out by periodic compaction, and a queue overflow
+    falls back to a full (resuming) DiskReader scan.
+
+    The size and mtime of every watched file are remembered, so a path that
+    only had attribute changes (chmod, chown, touch without a new mtime) is
+    not rehashed when neither differs from what was last recorded.
+    """
+
+    def __init__(
+        self,
+        directory: Text,
+        hashes_file: Text,
+        sizes_file: Text,
+        debounce: float,
+        compact_every: float,
+        max_lines: int,
+        initial_scan: bool = True,
+    ) -> None:
+        # Full scans and events must record the same paths for a file
+        absolute_directory = os.path.abspath(directory)
+        self.directory = os.fsencode(absolute_directory)
+        self.hashes_file = hashes_file
+        self.sizes_file = sizes_file
+        self.debounce = debounce
+        self.compact_every = compact_every
+        self.max_lines = max_lines
+        self.initial_scan = initial_scan
+        self.reader = DiskReader(
+            absolute_directory, hashes_file, sizes_file, False, False
+        )
+        # Path -> (last event time, whether only attributes changed)
+        self.pending = dict()  # type: Dict[bytes, Tuple[float, bool]]
+        # Path -> (size, mtime in ns) as of its current record
+        self.recorded = dict()  # type: Dict[bytes, Tuple[int, int]]
+        self.appended = 0
+        self.last_compaction = monotonic()
+
+    def full_scan(self) -> None:
+        print("Running full scan...")
+        self.reader.run()
+
+    def run(self) -> None:
+        while True:
+            inotify = Inotify()
+            try:
+                print("Adding watches...")
+                self.recorded.clear()
+                for file_path in inotify.add_tree(self.directory):
+                    self.remember(file_path)
+                # Catch up on changes made while nothing was watching; the
+                # scan resumes from the inventory, so only those get rehashed
+                if self.initial_scan or not os.path.exists(self.hashes_file):
+                    self.full_scan()
+                self.initial_scan = True
+                print("Watching {} directories".format(len(inotify.paths_by_wd)))
+                self.watch(inotify)
+            except WatchOverflow:
+                # The scan after the watches are re-added catches up
+                print("Event queue overflowed; rescanning")
+                self.pending.clear()
+            finally:
+                inotify.close()
+
+    def watch(self, inotify: Inotify) -> None:
+        while True:
+            for mask, event_path in inotify.read_events(self.debounce / 2 or 1):
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        for file_path in inotify.add_tree(event_path):
+                            self.queue(file_path, False)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self.queue(event_path, False)
+                elif mask & IN_ATTRIB:
+                    self.queue(event_path, True)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.recorded.pop(event_path, None)
+            self.flush()
+            if monotonic() - self.last_compaction >= self.compact_every:
+                self.compact()
+
+    def queue(self, path_bytes: bytes, attributes_only: bool) -> None:
+        previous = self.pending.get(path_bytes)
+        if previous is not None and not previous[1]:
+            attributes_only = False
+        self.pending[path_bytes] = (monotonic(), attributes_only)
+
+    def remember(self, path_bytes: bytes) -> None:
+        try:
+            st = os.lstat(path_bytes)
+        except FileNotFoundError:
+            return
+        if stat.S_ISREG(st.st_mode):
+            self.recorded[path_bytes] = (st.st_size, st.st_mtime_ns)
+
+    def flush(self) -> None:
+        now = monotonic()
+        ready = [
+            (path_bytes, attributes_only)
+            for path_bytes, (seen, attributes_only) in self.pending.items()
+            if now - seen >= self.debounce
+        ]
+        if not ready:
+            return
+
+        with open_inventory(
+            self.hashes_file, "a"
+        ) as hashes_file_handle, open_inventory(
+            self.sizes_file, "a"
+        ) as sizes_file_handle:
+            written = 0
+            for path_bytes, attributes_only in ready:
+                del self.pending[path_bytes]
+                try:
+                    st = os.lstat(path_bytes)
+                except FileNotFoundError:
+                    # Deleted again; compaction drops its old records
+                    self.recorded.pop(path_bytes, None)
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                current = (st.st_size, st.st_mtime_ns)
+                if attributes_only and self.recorded.get(path_bytes) == current:
+                    continue
+                self.reader.process_file(
+                    path_bytes, {}, {}, hashes_file_handle, sizes_file_handle
+                )
+                self.recorded[path_bytes] = current
+                written += 1
+        if written:
+            self.appended += written
+            print("Updated {} files ({} total)".format(written, self.appended))
+
+    def compact(self) -> None:
+        print("Compacting inventory...")
+        for inventory_file, is_hashes in (
+            (self.hashes_file, True),
+            (self.sizes_file, False),
+        ):
+            if os.path.exists(inventory_file):
+                compact(
+                    inventory_file,
+                    inventory_file,
+                    is_hashes,
+                    "path",
+                    True,
+                    self.max_lines,
+                    None,
+                )
+        self.last_compaction = monotonic()
+
+
+if __name__ == "__main__":
+    assert sys.platform.startswith("linux"), "Watch mode needs Linux inotify"
+
+    parser = argparse.ArgumentParser(
+        description="Keep a hashes/sizes inventory current by watching a tree "
+        "with inotify"
+    )
+    parser.add_argument("directory", help="root directory to watch")
+    parser.add_argument("-z", "--hashes_file", help="hashes file path")
+    parser.add_argument("-s", "--sizes_file", help="sizes file path")
+    parser.add_argument(
+        "-d",
+        "--debounce",
+        type=float,
+        default=5.0,
+        help="seconds a file must stay unchanged before it is rehashed",
+    )
+    parser.add_argument(
+        "-c",
+        "--compact-every",
+        type=float,
+        default=3600.0,
+        help="seconds between compactions, which also drop deleted files",
+    )
+    parser.add_argument(
+        "-m",
+        "--max-lines",
+        type=int,
+        default=DEFAULT_MAX_LINES,
+        help="lines sorted in memory while compacting",
+    )
+    parser.add_argument(
+        "--skip-initial-scan",
+        help="trust the existing inventory instead of rescanning on startup",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    dirname = os.path.basename(os.path.normpath(args.directory))
+    assert dirname
+
+    hashes_file = os.path.abspath(args.hashes_file or dirname + "_files_hashes.txt")
+    sizes_file = os.path.abspath(args.sizes_file or dirname + "_files_sizes.txt")
+
+    watcher = InventoryWatcher(
+        args.directory,
+        hashes_file,
+        sizes_file,
+        args.debounce,
+        args.compact_every,
+        args.max_lines,
+        not args.skip_initial_scan,
+    )
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print()
+        print("Stopped")